@@ -0,0 +1,340 @@
+from dataclasses import dataclass
+import bisect
+import calendar
+import itertools
+import math
+import statistics
+
+
+AGGREGATIONS = ("mean", "min", "max", "sum", "count")
+# Days are placed on a 366 day calendar, Feb 29 has its own slot that only leap years fill
+DAY_SLOTS = 366
+LEAP_DAY_SLOT = 59
+
+
+@dataclass
+class Summary:
+    count: int
+    sum: float
+    min: float
+    max: float
+
+    @property
+    def mean(self):
+        if self.count == 0:
+            raise statistics.StatisticsError("mean requires at least one data point")
+        return self.sum / self.count
+
+    def get(self, aggregation):
+        if aggregation not in AGGREGATIONS:
+            raise ValueError(f"Invalid aggregation: {aggregation}")
+        if aggregation in ("min", "max") and self.count == 0:
+            raise statistics.StatisticsError(f"{aggregation} requires at least one data point")
+        return getattr(self, aggregation)
+
+
+def percentile(sorted_values, fraction):
+    # Linear interpolation between the closest ranks
+    position = (len(sorted_values) - 1) * fraction
+    lower = math.floor(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def t_quantile(p, degrees_of_freedom):
+    # Student's t quantile, exact for 1 and 2 degrees of freedom. Above that a Cornish-Fisher
+    # expansion around the normal quantile, off by 0.03 at 3 and less than 1e-3 from 8 on.
+    n = degrees_of_freedom
+    if n == 1:
+        return math.tan(math.pi * (p - 0.5))
+    if n == 2:
+        return (2 * p - 1) / math.sqrt(2 * p * (1 - p))
+    z = statistics.NormalDist().inv_cdf(p)
+    return (
+        z + (z**3 + z) / (4 * n) + (5 * z**5 + 16 * z**3 + 3 * z) / (96 * n**2)
+        + (3 * z**7 + 19 * z**5 + 17 * z**3 - 15 * z) / (384 * n**3)
+    )
+
+
+def linear_trends(grid, years, confidence=0.95):
+    # Least squares slope per column of a year x column grid, skipping NaN cells. All columns
+    # are solved together from running sums in one pass over the grid. Returns per column the
+    # slope per year and the half width of its confidence interval, None with fewer than 3 years.
+    num_columns = len(grid[0]) if grid else 0
+    n = [0] * num_columns
+    sum_x = [0.0] * num_columns
+    sum_y = [0.0] * num_columns
+    sum_xx = [0.0] * num_columns
+    sum_xy = [0.0] * num_columns
+    sum_yy = [0.0] * num_columns
+    # Years are counted from the first one to keep the sums small
+    origin = years[0] if years else 0
+    for year, row in zip(years, grid):
+        x = year - origin
+        for column, value in enumerate(row):
+            if math.isnan(value):
+                continue
+            n[column] += 1
+            sum_x[column] += x
+            sum_y[column] += value
+            sum_xx[column] += x * x
+            sum_xy[column] += x * value
+            sum_yy[column] += value * value
+    results = []
+    for column in range(num_columns):
+        if n[column] < 3:
+            results.append((None, None))
+            continue
+        sxx = sum_xx[column] - sum_x[column] ** 2 / n[column]
+        sxy = sum_xy[column] - sum_x[column] * sum_y[column] / n[column]
+        syy = sum_yy[column] - sum_y[column] ** 2 / n[column]
+        slope = sxy / sxx
+        residual_variance = max(syy - slope * sxy, 0.0) / (n[column] - 2)
+        standard_error = math.sqrt(residual_variance / sxx)
+        results.append((slope, t_quantile((1 + confidence) / 2, n[column] - 2) * standard_error))
+    return results
+
+
+def day_slot(year, day_of_year):
+    slot = day_of_year - 1
+    if slot >= LEAP_DAY_SLOT and not calendar.isleap(year):
+        slot += 1
+    return slot
+
+
+def year_day_slots(year):
+    # Slots of the days of one year in calendar order
+    slots = list(range(DAY_SLOTS))
+    if not calendar.isleap(year):
+        del slots[LEAP_DAY_SLOT]
+    return slots
+
+
+class YearMonthMatrix:
+    # Reduces a station's monthly data to a year x month grid per parameter. Sums and counts
+    # are kept as prefix sums over years, so the sum and count of any window of years is a
+    # single subtraction per month.
+
+    def __init__(self, station_data):
+        self.station_data = station_data
+        years = station_data.timestamps.years
+        self.first_year = min(years)
+        self.num_years = max(years) - self.first_year + 1
+        self.grids = {}
+
+    def parameter_grid(self, parameter_name):
+        if parameter_name not in self.grids:
+            sums = [[0.0] * 12 for year in range(self.num_years)]
+            counts = [[0] * 12 for year in range(self.num_years)]
+            minima = [[math.inf] * 12 for year in range(self.num_years)]
+            maxima = [[-math.inf] * 12 for year in range(self.num_years)]
+            timestamps = self.station_data.timestamps
+            column = self.station_data.columns[parameter_name]
+            for value, year, month in zip(column, timestamps.years, timestamps.months):
+                if math.isnan(value):
+                    continue
+                year_index = year - self.first_year
+                sums[year_index][month - 1] += value
+                counts[year_index][month - 1] += 1
+                minima[year_index][month - 1] = min(minima[year_index][month - 1], value)
+                maxima[year_index][month - 1] = max(maxima[year_index][month - 1], value)
+            prefix_sums = [[0.0] * 12]
+            prefix_counts = [[0] * 12]
+            for year_sums, year_counts in zip(sums, counts):
+                prefix_sums.append([a + b for a, b in zip(prefix_sums[-1], year_sums)])
+                prefix_counts.append([a + b for a, b in zip(prefix_counts[-1], year_counts)])
+            self.grids[parameter_name] = (prefix_sums, prefix_counts, minima, maxima)
+        return self.grids[parameter_name]
+
+    def year_indices(self, window):
+        start, end = window
+        return (
+            min(max(start - self.first_year, 0), self.num_years),
+            min(max(end - self.first_year + 1, 0), self.num_years)
+        )
+
+    def summaries(self, parameter_name, window):
+        prefix_sums, prefix_counts, minima, maxima = self.parameter_grid(parameter_name)
+        first, stop = self.year_indices(window)
+        results = []
+        for month_index in range(12):
+            count = prefix_counts[stop][month_index] - prefix_counts[first][month_index]
+            if count == 0:
+                results.append(Summary(0, 0.0, math.nan, math.nan))
+                continue
+            results.append(Summary(
+                count,
+                prefix_sums[stop][month_index] - prefix_sums[first][month_index],
+                min(minima[year_index][month_index] for year_index in range(first, stop)),
+                max(maxima[year_index][month_index] for year_index in range(first, stop))
+            ))
+        return results
+
+    def year_means(self, parameter_name):
+        # Year x month grid of means, NaN where a month has no data
+        prefix_sums, prefix_counts, minima, maxima = self.parameter_grid(parameter_name)
+        grid = []
+        for year_index in range(self.num_years):
+            row = []
+            for month_index in range(12):
+                count = prefix_counts[year_index + 1][month_index] - prefix_counts[year_index][month_index]
+                if count == 0:
+                    row.append(math.nan)
+                    continue
+                total = prefix_sums[year_index + 1][month_index] - prefix_sums[year_index][month_index]
+                row.append(total / count)
+            grid.append(row)
+        return grid
+
+    def anomalies(self, parameter_name, window):
+        # Year x month grid of each month's mean minus the window's mean of that calendar month,
+        # NaN where either is missing
+        normals = [
+            summary.sum / summary.count if summary.count else math.nan
+            for summary in self.summaries(parameter_name, window)
+        ]
+        return [
+            [value - normal for value, normal in zip(row, normals)]
+            for row in self.year_means(parameter_name)
+        ]
+
+
+class MonthlyAggregates:
+    # Per calendar month aggregates of one window of years. The results of each
+    # (parameter, aggregation) are computed on first use and shared by all table builders.
+
+    def __init__(self, matrix, window):
+        self.matrix = matrix
+        self.window = window
+        self.summaries = {}
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def parameter_summaries(self, parameter_name):
+        if parameter_name not in self.summaries:
+            self.summaries[parameter_name] = self.matrix.summaries(parameter_name, self.window)
+        return self.summaries[parameter_name]
+
+    def coverage(self, parameter_name):
+        # Share of the window's years with a value, per month
+        expected = self.window[1] - self.window[0] + 1
+        return [summary.count / expected for summary in self.parameter_summaries(parameter_name)]
+
+    def trends(self, parameter_name):
+        first, stop = self.matrix.year_indices(self.window)
+        years = range(self.matrix.first_year + first, self.matrix.first_year + stop)
+        return linear_trends(self.matrix.year_means(parameter_name)[first:stop], years)
+
+    def months(self, parameter_name, aggregation):
+        key = (parameter_name, aggregation)
+        if key in self.cache:
+            self.hits += 1
+            return self.cache[key]
+        self.misses += 1
+        result = [summary.get(aggregation) for summary in self.parameter_summaries(parameter_name)]
+        self.cache[key] = result
+        return result
+
+
+class DailyAggregates:
+    # Lazily computed views of a station's daily data that several tables share
+
+    def __init__(self, station_data):
+        self.station_data = station_data
+        self.sorted_columns = {}
+        self.month_sorted_columns = {}
+        self.day_slot_columns = {}
+        self.num_years = len(set(station_data.timestamps.years))
+
+    def sorted_rounded(self, parameter_name):
+        # Values rounded to whole numbers and sorted once, so counting any value range
+        # takes two binary searches
+        if parameter_name not in self.sorted_columns:
+            self.sorted_columns[parameter_name] = sorted(
+                int(round(value)) for value in self.station_data.columns[parameter_name]
+                if not math.isnan(value)
+            )
+        return self.sorted_columns[parameter_name]
+
+    def histogram(self, parameter_name, low, high, bucket_size):
+        # Counts of rounded values in [bucket_low, bucket_low + bucket_size) for every
+        # bucket_low in range(low, high, bucket_size)
+        values = self.sorted_rounded(parameter_name)
+        bucket_lows = range(low, high, bucket_size)
+        edges = [bisect.bisect_left(values, bucket_low) for bucket_low in bucket_lows]
+        edges.append(bisect.bisect_left(values, bucket_lows[-1] + bucket_size))
+        return [edge_high - edge_low for edge_low, edge_high in zip(edges[:-1], edges[1:])]
+
+    def month_sorted(self, parameter_name):
+        # Per calendar month the sorted values and their prefix sums
+        if parameter_name not in self.month_sorted_columns:
+            column = self.station_data.columns[parameter_name]
+            month_values = [[] for month in range(12)]
+            for value, month in zip(column, self.station_data.timestamps.months):
+                if not math.isnan(value):
+                    month_values[month - 1].append(value)
+            self.month_sorted_columns[parameter_name] = []
+            for values in month_values:
+                values.sort()
+                prefix_sums = list(itertools.accumulate(values, initial=0.0))
+                self.month_sorted_columns[parameter_name].append((values, prefix_sums))
+        return self.month_sorted_columns[parameter_name]
+
+    def heating_degree_days(self, parameter_name, threshold, base):
+        # Per month the number of days below threshold and the sum of base - value over them
+        results = []
+        for values, prefix_sums in self.month_sorted(parameter_name):
+            days = bisect.bisect_left(values, threshold)
+            results.append((days, days * base - prefix_sums[days]))
+        return results
+
+    def cooling_degree_days(self, parameter_name, threshold, base):
+        # Per month the number of days above threshold and the sum of value - base over them
+        results = []
+        for values, prefix_sums in self.month_sorted(parameter_name):
+            first = bisect.bisect_right(values, threshold)
+            days = len(values) - first
+            results.append((days, prefix_sums[-1] - prefix_sums[first] - days * base))
+        return results
+
+    def day_slots(self, parameter_name):
+        # Per day of year the sorted values of all years
+        if parameter_name not in self.day_slot_columns:
+            timestamps = self.station_data.timestamps
+            slots = [[] for slot in range(DAY_SLOTS)]
+            for value, year, day_of_year in zip(
+                    self.station_data.columns[parameter_name], timestamps.years, timestamps.days_of_year):
+                if not math.isnan(value):
+                    slots[day_slot(year, day_of_year)].append(value)
+            for values in slots:
+                values.sort()
+            self.day_slot_columns[parameter_name] = slots
+        return self.day_slot_columns[parameter_name]
+
+    def day_climatology(self, parameter_name, fractions):
+        # Per day slot the mean and the requested percentiles, None where no year has data
+        results = []
+        for values in self.day_slots(parameter_name):
+            if not values:
+                results.append((None, [None] * len(fractions)))
+                continue
+            results.append((
+                math.fsum(values) / len(values),
+                [percentile(values, fraction) for fraction in fractions]
+            ))
+        return results
+
+
+def combine_stations(station_values, weights):
+    # Reduces a station x month array of one parameter to the per month mean, weighted mean
+    # and envelope over all stations
+    combined = {"mean": [], "weighted": [], "low": [], "high": []}
+    weight_sum = math.fsum(weights)
+    for month_values in zip(*station_values):
+        combined["mean"].append(math.fsum(month_values) / len(month_values))
+        combined["weighted"].append(
+            math.fsum(value * weight for value, weight in zip(month_values, weights)) / weight_sum)
+        combined["low"].append(min(month_values))
+        combined["high"].append(max(month_values))
+    return combined
@@ -2,10 +2,14 @@ from dataclasses import dataclass
 import datetime
 import xml.etree.ElementTree as etree
 import copy
+import functools
+import itertools
 import math
+import operator
+import re
 
 
-@dataclass
+@dataclass(frozen=True)
 class Scale:
     low: int
     high: int
@@ -75,8 +79,216 @@ def subscale_labels(subscale, fullscale):
             labels.append(None)
     return labels
 
+def safe_attributes(attrib):
+    safe_attrib = {}
+    for key, value in attrib.items():
+        attrib_name = key.replace('_', '-')
+        if isinstance(value, float):
+            value_str = str(round(value, 2))
+        else:
+            value_str = str(value)
+        safe_attrib[attrib_name] = value_str
+    return safe_attrib
+
+def css_value(name, value):
+    # Unlike attributes, CSS lengths need a unit
+    if name in LENGTH_PROPERTIES and re.fullmatch(r"[0-9.]+", value):
+        return value + "px"
+    return value
+
+class EtreeBackend:
+    # Builds the chart as an ElementTree, the elements can still be changed after adding them
+
+    def __init__(self, root_attrib):
+        self.svg_root = etree.Element("svg", attrib=root_attrib)
+
+    def add(self, tag, attrib, text):
+        element = etree.SubElement(self.svg_root, tag, attrib)
+        element.text = text
+        return element
+
+    def insert_first(self, tag, attrib, text):
+        element = etree.Element(tag, attrib)
+        element.text = text
+        self.svg_root.insert(0, element)
+        return element
+
+    def mark(self):
+        return len(self.svg_root)
+
+    def layer_since(self, mark):
+        # Deep copies, etree.indent in a pretty save would change the cached elements otherwise
+        return tuple(copy.deepcopy(element) for element in self.svg_root[mark:])
+
+    def add_layer(self, layer):
+        self.svg_root.extend(copy.deepcopy(element) for element in layer)
+
+    def save(self, filename, pretty):
+        if pretty:
+            etree.indent(self.svg_root)
+        tree = etree.ElementTree(self.svg_root)
+        tree.write(
+            filename,
+            encoding="utf-8",
+            xml_declaration=True,
+            method="xml",
+            short_empty_elements=True
+        )
+
+    def tostring(self, pretty):
+        if pretty:
+            etree.indent(self.svg_root)
+        return etree.tostring(self.svg_root, encoding="unicode", xml_declaration=True)
+
+
+TEXT_SPECIAL = re.compile(r"[&<>]")
+ATTRIB_SPECIAL = re.compile(r'[&<>"\r\n\t]')
+
+def escape_text(text):
+    if TEXT_SPECIAL.search(text) is None:
+        return text
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+# Attributes repeat a lot between elements, mostly from the style
+@functools.lru_cache(maxsize=4096)
+def serialize_attrib(name, value):
+    # Same escapes as ElementTree
+    if ATTRIB_SPECIAL.search(value) is not None:
+        value = escape_text(value).replace("\"", "&quot;")
+        value = value.replace("\r", "&#13;").replace("\n", "&#10;").replace("\t", "&#09;")
+    return f' {name}="{value}"'
+
+def start_tag(tag, attrib):
+    # Opening tag without the closing bracket
+    return "".join([f"<{tag}"] + [serialize_attrib(name, value) for name, value in attrib.items()])
+
+def serialize_element(tag, attrib, text):
+    if text:
+        return f"{start_tag(tag, attrib)}>{escape_text(text)}</{tag}>"
+    return f"{start_tag(tag, attrib)} />"
+
+class StreamBackend:
+    # Serializes every element as soon as it is added instead of building a tree. The output
+    # is identical to the EtreeBackend's, elements can't be changed after adding them.
+
+    def __init__(self, root_attrib):
+        self.root_attrib = root_attrib
+        self.elements = []
+
+    def add(self, tag, attrib, text):
+        self.elements.append(serialize_element(tag, attrib, text))
+
+    def insert_first(self, tag, attrib, text):
+        self.elements.insert(0, serialize_element(tag, attrib, text))
+
+    def mark(self):
+        return len(self.elements)
+
+    def layer_since(self, mark):
+        return tuple(self.elements[mark:])
+
+    def add_layer(self, layer):
+        self.elements.extend(layer)
+
+    def pieces(self, pretty):
+        yield "<?xml version='1.0' encoding='utf-8'?>\n"
+        if not self.elements:
+            yield serialize_element("svg", self.root_attrib, None)
+            return
+        separator = "\n  " if pretty else ""
+        yield start_tag("svg", self.root_attrib) + ">"
+        for element in self.elements:
+            yield separator
+            yield element
+        yield "\n" if pretty else ""
+        yield "</svg>"
+
+    def save(self, filename, pretty):
+        with open(filename, "w", encoding="utf-8", newline="") as f:
+            f.writelines(self.pieces(pretty))
+
+    def tostring(self, pretty):
+        return "".join(self.pieces(pretty))
+
+
+BACKENDS = {
+    "etree": EtreeBackend,
+    "stream": StreamBackend
+}
+default_backend = "stream"
+# "inline" repeats the style as attributes on every element, "class" refers to a <style> block.
+# An external stylesheet wouldn't work, images don't load other resources.
+default_style_mode = "class"
+# Style keys the chart code uses for layout, they aren't CSS properties
+LAYOUT_KEYS = {"margin", "width", "height", "spacing"}
+LENGTH_PROPERTIES = {"stroke-width", "font-size"}
+MAX_PATH_PRECISION = 4
+# Static layers by key, see Chart.add_static_layer
+static_layers = {}
+STATIC_LAYER_CACHE_SIZE = 256
+
+
+TRAILING_ZEROS = re.compile(r"\.0+\b|(\.\d*[1-9])0+\b")
+NEGATIVE_ZERO = re.compile(r"-0(?![.\d])")
+
+
+def compact_numbers(text):
+    # Drops trailing zeros of every fixed point number in the text and the sign of -0
+    return NEGATIVE_ZERO.sub("0", TRAILING_ZEROS.sub(r"\1", text))
+
+def format_number(value, precision):
+    # Shortest form with at most precision decimals
+    return compact_numbers(f"{value:.{precision}f}")
+
+def format_fixed_point(xs, ys, precision):
+    # "x,y x,y ..." of coordinates given as integers in units of 10**-precision. The quotients
+    # are the closest floats to those decimals, so repr gives their shortest form, only the .0
+    # of whole numbers has to go. repr switches to exponents below 1e-4, see MAX_PATH_PRECISION.
+    scale = 10 ** precision
+    text = " ".join(map("{!r},{!r}".format, [x / scale for x in xs], [y / scale for y in ys]))
+    text = text.replace(".0,", ",").replace(".0 ", " ")
+    return text[:-2] if text.endswith(".0") else text
+
+def simplify_polyline(points, tolerance):
+    # Douglas-Peucker, keeps the end points and every point that is further than tolerance from
+    # the line between the kept points around it
+    if len(points) < 3:
+        return list(points)
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        x1, y1 = points[first]
+        dx = points[last][0] - x1
+        dy = points[last][1] - y1
+        length = math.hypot(dx, dy)
+        if length == 0:
+            distances = [math.hypot(x - x1, y - y1) for x, y in points[first + 1:last]]
+            limit = tolerance
+        else:
+            # Distances to the line, times its length
+            distances = [abs(dy * (x - x1) - dx * (y - y1)) for x, y in points[first + 1:last]]
+            limit = tolerance * length
+        max_distance = max(distances)
+        if max_distance > limit:
+            max_index = first + 1 + distances.index(max_distance)
+            keep[max_index] = True
+            stack.append((first, max_index))
+            stack.append((max_index, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+def value_bin(value, limit, num_bins):
+    # Index of the value in num_bins equal bins from -limit to limit, values outside are clamped
+    if value is None:
+        return None
+    fraction = (value + limit) / (2 * limit)
+    return min(max(int(fraction * num_bins), 0), num_bins - 1)
+
 class Chart:
-    def __init__(self, style):
+    def __init__(self, style, backend=None, style_mode=None):
         self.style = style
         self.draw_area = Box(
             style["draw-area"]["margin-left"], style["draw-area"]["margin-top"],
@@ -87,13 +299,29 @@ class Chart:
             self.draw_area.left + self.draw_area.width + style["draw-area"]["margin-right"],
             self.draw_area.top + self.draw_area.height + style["draw-area"]["margin-bottom"]
         )
-        self.svg_root = etree.Element("svg", attrib={
+        root_attrib = {
             "baseProfile": "full",
             "version": "1.1",
             "xmlns": "http://www.w3.org/2000/svg",
             "width": str(self.image_area.width),
             "height": str(self.image_area.height)
-        })
+        }
+        if backend is None:
+            backend = default_backend
+        self.backend = BACKENDS[backend](root_attrib)
+        self.attrib_cache = {}
+        if style_mode is None:
+            style_mode = default_style_mode
+        if style_mode not in ("inline", "class"):
+            raise ValueError(f"Invalid style_mode: {style_mode}")
+        # In class mode elements only get the name of their style section as class, the
+        # sections that were used go into a <style> block
+        self.style_mode = style_mode
+        self.section_names = {id(section): name for name, section in style.items()}
+        self.used_sections = {}
+        self.stylesheet_added = False
+        self.x_edges_px = []
+        self.y_edges_px = []
         self.scale_left = None
         self.scale_right = None
         self.legend = {}
@@ -137,18 +365,21 @@ class Chart:
             for y_frac in calc_edges(self.scale_steps)
         ]
 
-    def add_element(self, tag, attrib={}, **extra):
-        attrib_merged = attrib.copy()
-        attrib_merged.update(extra)
-        safe_attrib = {}
-        for key, value in attrib_merged.items():
-            attrib_name = key.replace('_', '-')
-            if isinstance(value, float):
-                value_str = str(round(value, 2))
-            else:
-                value_str = str(value)
-            safe_attrib[attrib_name] = value_str
-        return etree.SubElement(self.svg_root, tag, safe_attrib)
+    def add_element(self, tag, attrib={}, text=None, **extra):
+        section_name = self.section_names.get(id(attrib))
+        if self.style_mode == "class" and self.style.get(section_name) is attrib:
+            self.used_sections[section_name] = attrib
+            safe_attrib = {"class": section_name}
+            safe_attrib.update(safe_attributes(extra))
+            return self.backend.add(tag, safe_attrib, text)
+        # Style dicts are passed again for every element, they are only converted once per chart
+        cached = self.attrib_cache.get(id(attrib))
+        if cached is None or cached[0] is not attrib:
+            cached = (attrib, safe_attributes(attrib))
+            self.attrib_cache[id(attrib)] = cached
+        safe_attrib = cached[1].copy()
+        safe_attrib.update(safe_attributes(extra))
+        return self.backend.add(tag, safe_attrib, text)
 
     def add_rect(self, x, y, width, height, attrib, **extra):
         return self.add_element("rect", attrib, x=x, y=y, width=width, height=height, **extra)
@@ -157,9 +388,7 @@ class Chart:
         return self.add_element("line", attrib, x1=x1, y1=y1, x2=x2, y2=y2, **extra)
 
     def add_text(self, text, x, y, attrib, **extra):
-        text_elem = self.add_element("text", attrib, x=x, y=y, **extra)
-        text_elem.text = text
-        return text_elem
+        return self.add_element("text", attrib, text=text, x=x, y=y, **extra)
 
     def add_path(self, d, attrib, **extra):
         if isinstance(d, str):
@@ -169,22 +398,71 @@ class Chart:
 
         return self.add_element("path", attrib, d=d_str, **extra)
 
-    def save(self, filename, pretty=False):
-        if pretty:
-            etree.indent(self.svg_root)
-        tree = etree.ElementTree(self.svg_root)
-        tree.write(
-            filename,
-            encoding="utf-8",
-            xml_declaration=True,
-            method="xml",
-            short_empty_elements=True
+    def add_stylesheet(self):
+        if self.stylesheet_added or not self.used_sections:
+            return
+        rules = []
+        for section_name, section in self.used_sections.items():
+            declarations = "; ".join(
+                f"{name}: {css_value(name, value)}" for name, value in safe_attributes(section).items()
+                if name not in LAYOUT_KEYS
+            )
+            rules.append(f".{section_name} {{ {declarations} }}")
+        self.backend.insert_first("style", {}, "\n".join(rules))
+        self.stylesheet_added = True
+
+    def add_static_layer(self, draw, *args):
+        # draw(self, *args) adds elements that only depend on the args and on the chart's style,
+        # x and y edges, scales and legend, like the grid and the labels. Charts where all of
+        # these are equal get a copy of the elements that were added for the first one instead of
+        # drawing them again. draw has to be a module level function or a method, not a closure.
+        key = (
+            draw, args, repr(self.style), self.style_mode, type(self.backend),
+            tuple(self.x_edges_px), tuple(self.y_edges_px), self.scale_left, self.scale_right,
+            tuple(self.legend.items())
         )
+        layer = static_layers.get(key)
+        if layer is None:
+            outer_sections = self.used_sections
+            self.used_sections = {}
+            mark = self.backend.mark()
+            draw(self, *args)
+            layer = (self.backend.layer_since(mark), tuple(self.used_sections))
+            self.used_sections = outer_sections
+            if len(static_layers) >= STATIC_LAYER_CACHE_SIZE:
+                del static_layers[next(iter(static_layers))]
+            static_layers[key] = layer
+        else:
+            self.backend.add_layer(layer[0])
+        for section_name in layer[1]:
+            self.used_sections.setdefault(section_name, self.style[section_name])
+
+    def draw_axes(self, labels, unit_left, unit_right=None):
+        # Everything but the data and the border for charts with labels between the x edges,
+        # the legend only if it was set up before. Shared through the static layer cache.
+        self.add_static_layer(Chart.draw_axes_layer, tuple(labels), unit_left, unit_right)
+
+    def draw_axes_layer(self, labels, unit_left, unit_right):
+        self.add_background()
+        self.draw_subdivisions()
+        self.draw_baseline()
+        self.draw_labels_x_between(labels)
+        self.draw_labels_left()
+        if unit_right is not None:
+            self.draw_labels_right()
+        self.draw_unit_left(unit_left)
+        if unit_right is not None:
+            self.draw_unit_right(unit_right)
+        if self.legend:
+            self.draw_legend()
+
+    def save(self, filename, pretty=False):
+        self.add_stylesheet()
+        self.backend.save(filename, pretty)
 
     def tostring(self, pretty=False):
-        if pretty:
-            etree.indent(self.svg_root)
-        return etree.tostring(self.svg_root, encoding="unicode", xml_declaration=True)
+        self.add_stylesheet()
+        return self.backend.tostring(pretty)
 
     def add_background(self):
         self.add_rect(
@@ -206,6 +484,13 @@ class Chart:
             for x_fract in x_edges_fract
         ]
 
+    def set_y_edges(self, y_edges_fract):
+        # For charts without a value scale, e.g. heatmaps with one band per row
+        self.y_edges_px = [
+            self.draw_area.top + y_fract * self.draw_area.height
+            for y_fract in y_edges_fract
+        ]
+
     def set_left_scale(self, scale):
         self.scale_left = scale
         self.calc_scales()
@@ -244,6 +529,8 @@ class Chart:
 
     def draw_labels_x_between(self, labels):
         for x_pos, label in zip(self.x_edges_between(), labels):
+            if label is None:
+                continue
             self.add_text(
                 label, x=x_pos, y=self.draw_area.bottom + self.style["label-x"]["margin"],
                 text_anchor="middle", attrib=self.style["label-x"]
@@ -289,6 +576,14 @@ class Chart:
                     text_anchor="end", dominant_baseline="middle", attrib=self.style["label-right"]
                 )
 
+    def draw_labels_y_between(self, labels):
+        y_edges = self.y_edges_with_outer()
+        for (y1, y2), label in zip(pairs(y_edges), labels):
+            self.add_text(
+                label, x=self.draw_area.left - self.style["label-left"]["margin"], y=(y1 + y2) / 2,
+                text_anchor="end", dominant_baseline="middle", attrib=self.style["label-left"]
+            )
+
     def draw_unit_left(self, unit):
         self.add_text(
             unit, x=self.draw_area.left - self.style["unit-left"]["margin"], y=self.draw_area.top,
@@ -350,63 +645,145 @@ class Chart:
 
     def baseline_points(self):
         return [
-            f"{self.draw_area.left},{self.baseline_y}",
-            f"{self.draw_area.right},{self.baseline_y}"
+            (self.draw_area.left, self.baseline_y),
+            (self.draw_area.right, self.baseline_y)
         ]
 
-    def draw_bars(self, series_name, datapoints, side):
+    def to_y(self, datapoints, side):
+        # Pixel y of every value in one affine pass
         scaler = self.get_scaler(side)
+        return list(map(
+            operator.sub, itertools.repeat(self.baseline_y),
+            map(operator.mul, datapoints, itertools.repeat(scaler))
+        ))
+
+    def draw_bars(self, series_name, datapoints, side):
+        baseline_y = self.baseline_y
+        for val_y, (x1, x2) in zip(self.to_y(datapoints, side), pairs(self.x_edges_with_outer())):
+            bar_points = [(x1, baseline_y), (x1, val_y), (x2, val_y), (x2, baseline_y)]
+            self.add_path(self.path_data(bar_points), attrib=self.series_style(series_name))
 
-        for val, (x1, x2) in zip(datapoints, pairs(self.x_edges_with_outer())):
-            val_y = self.baseline_y - val * scaler
-            command = f"M {x1},{self.baseline_y} {x1},{val_y} {x2},{val_y} {x2},{self.baseline_y}"
-            self.add_path(command, attrib=self.series_style(series_name))
+    # The batch methods take a dict of series that share the x positions and the scale and
+    # return their points under the same keys. The x positions and the scaler are computed
+    # once for all series.
 
-    def to_line(self, datapoints, side, x_type):
-        scaler = self.get_scaler(side)
+    def to_lines(self, series, side, x_type):
         x_vals = self.get_x_edges(x_type)
+        lines = {}
+        for name, datapoints in series.items():
+            points = list(zip(x_vals, self.to_y(datapoints, side)))
+            if x_type == "between":
+                wrap_y, = self.to_y([(datapoints[0] + datapoints[-1]) / 2], side)
+                points = [(self.draw_area.left, wrap_y)] + points + [(self.draw_area.right, wrap_y)]
+            lines[name] = points
+        return lines
+
+    def to_stepped_lines(self, series, side):
+        x_pairs = list(pairs(self.x_edges_with_outer()))
+        lines = {}
+        for name, datapoints in series.items():
+            lines[name] = [
+                point
+                for (x1, x2), y in zip(x_pairs, self.to_y(datapoints, side))
+                for point in ((x1, y), (x2, y))
+            ]
+        return lines
+
+    def lines_from_xy(self, x_fracts, series, side):
+        # x_fracts are fractions of the draw area width, values that are None are left out
+        x_vals = [self.draw_area.left + x_fract * self.draw_area.width for x_fract in x_fracts]
+        lines = {}
+        for name, datapoints in series.items():
+            if None in datapoints:
+                kept = [(x, val) for x, val in zip(x_vals, datapoints) if val is not None]
+                series_x = [x for x, _ in kept]
+                datapoints = [val for _, val in kept]
+            else:
+                series_x = x_vals
+            lines[name] = list(zip(series_x, self.to_y(datapoints, side)))
+        return lines
 
-        points = []
-        if x_type == "between":
-            wrap_val = (datapoints[0] + datapoints[-1]) / 2
-            wrap_y = self.baseline_y - wrap_val * scaler
-            points.append(f"{self.draw_area.left},{wrap_y}")
-        for val, x in zip(datapoints, x_vals):
-            y = self.baseline_y - val * scaler
-            points.append(f"{x},{y}")
-        if x_type == "between":
-            points.append(f"{self.draw_area.right},{wrap_y}")
-        return points
+    def to_line(self, datapoints, side, x_type):
+        return self.to_lines({"line": datapoints}, side, x_type)["line"]
 
     def to_stepped_line(self, datapoints, side):
-        scaler = self.get_scaler(side)
-
-        points = []
-        for val, (x1, x2) in zip(datapoints, pairs(self.x_edges_with_outer())):
-            y = self.baseline_y - val * scaler
-            points.append(f"{x1},{y}")
-            points.append(f"{x2},{y}")
-        return points
+        return self.to_stepped_lines({"line": datapoints}, side)["line"]
 
     def line_from_xy(self, datapoints, side):
-        scaler = self.get_scaler(side)
-        points = []
-        for x_fract, y_fract in datapoints:
-            x = self.draw_area.left + x_fract * self.draw_area.width
-            y = self.baseline_y - y_fract * scaler
-            points.append(f"{x},{y}")
-        return points
+        x_fracts = [x_fract for x_fract, _ in datapoints]
+        y_fracts = [y_fract for _, y_fract in datapoints]
+        return self.lines_from_xy(x_fracts, {"line": y_fracts}, side)["line"]
+
+    def format_number(self, value):
+        return format_number(value, self.style["path"]["precision"])
+
+    def path_data(self, points, closed=False):
+        # Path through (x, y) points in pixels, encoded as set in the style's path section:
+        # coordinates are rounded to precision digits, relative paths give the offsets from the
+        # previous point and a tolerance above 0 drops points that are closer than that to the
+        # simplified line
+        path_style = self.style["path"]
+        precision = path_style["precision"]
+        if precision > MAX_PATH_PRECISION:
+            raise ValueError(f"Invalid path precision: {precision}")
+        if path_style["tolerance"] > 0:
+            points = simplify_polyline(points, path_style["tolerance"])
+        # Fixed point integers, the relative offsets are exact differences of them
+        scale = 10 ** precision
+        xs = [round(x * scale) for x, _ in points]
+        ys = [round(y * scale) for _, y in points]
+        commands = ["M", format_fixed_point(xs[:1], ys[:1], precision)]
+        if len(xs) > 1:
+            if path_style["relative"]:
+                commands.append("l")
+                commands.append(format_fixed_point(
+                    list(map(operator.sub, xs[1:], xs)), list(map(operator.sub, ys[1:], ys)), precision))
+            else:
+                commands.append(" ")
+                commands.append(format_fixed_point(xs[1:], ys[1:], precision))
+        if closed:
+            commands.append("Z")
+        return "".join(commands)
 
     def draw_line(self, series_name, points):
-        commands = ["M"] + points
-        self.add_path(commands, attrib=self.series_style(series_name))
+        self.add_path(self.path_data(points), attrib=self.series_style(series_name))
 
     def draw_polygon(self, polygon_name, points):
-        commands = ["M"] + points + ["Z"]
-        self.add_path(commands, attrib=self.style["poly-" + polygon_name])
+        self.add_path(self.path_data(points, closed=True), attrib=self.style["poly-" + polygon_name])
+
+    def draw_heatmap(self, grid, limit, num_bins):
+        # grid has a row of values for every y band, top to bottom, and a value for every x band.
+        # Values are colored by the styles bin-0 to bin-<num_bins - 1>. Neighbouring cells of the
+        # same bin are merged and each bin is drawn as a single path, so the element count doesn't
+        # grow with the number of cells.
+        # Edges are formatted once, cells only pick them
+        x_edges = [self.format_number(x) for x in self.x_edges_with_outer()]
+        y_edges = [self.format_number(y) for y in self.y_edges_with_outer()]
+        bin_commands = [[] for bin_index in range(num_bins)]
+        for row, (y1, y2) in zip(grid, pairs(y_edges)):
+            row_bins = [value_bin(value, limit, num_bins) for value in row]
+            for bin_index, run in itertools.groupby(enumerate(row_bins), key=lambda cell: cell[1]):
+                run = list(run)
+                if bin_index is None:
+                    continue
+                x1 = x_edges[run[0][0]]
+                x2 = x_edges[run[-1][0] + 1]
+                bin_commands[bin_index].append(f"M{x1},{y1}H{x2}V{y2}H{x1}Z")
+        for bin_index, commands in enumerate(bin_commands):
+            if commands:
+                self.add_path("".join(commands), attrib=self.style[f"bin-{bin_index}"])
+
+    def draw_stripes(self, values, limit, num_bins):
+        # Warming stripes, a heatmap with a single row
+        self.draw_heatmap([values], limit, num_bins)
 
 
 default_style = {
+    "path": {  # all virtual
+        "precision": 2,
+        "relative": True,
+        "tolerance": 0  # pixels, simplifying costs more time than rounding
+    },
     "draw-area": {  # all virtual
         "width": 480,
         "height": 400,
@@ -508,4 +885,4 @@ def merge_styles(old, new):
                 merged[section][key] = new[section][key]
         else:
             merged[section] = new[section]
-    return merged
+    return merged
\ No newline at end of file
@@ -1,10 +1,13 @@
 import jinja2
 import json
-import configparser
-import pathlib
 import collections
+import pathlib
 import shutil
 
+import manifest
+from climate_tables import climate_windows
+from stations import stations_config, stations_meta, output_path
+
 
 
 jenv = jinja2.Environment(
@@ -12,43 +15,95 @@ jenv = jinja2.Environment(
     autoescape=True, trim_blocks=True, lstrip_blocks=True,
     keep_trailing_newline=False)
 
-stations_config = configparser.ConfigParser()
-stations_config.read_file(open("station_names.ini"))
-stations_meta = json.load(open("stations_meta.json"))
-output_path = pathlib.Path("out")
+states = [
+    "Burgenland", "Kärnten", "Niederösterreich", "Oberösterreich", "Salzburg", "Steiermark",
+    "Tirol", "Vorarlberg", "Wien"
+]
+
+
+def page_input_hash(template_name, page_args):
+    return manifest.content_hash(
+        manifest.file_hash(pathlib.Path("templates") / template_name),
+        json.dumps(page_args, sort_keys=True, ensure_ascii=False)
+    )
+
 
-stations_index = collections.defaultdict(list)
-for station in stations_meta.values():
-    station_id = station["id"]
+def write_station_page(station_id, station_charts):
+    # station_charts holds the names of the charts that were drawn for the station
+    station = stations_meta[station_id]
     station_slug = stations_config[station_id]["slug"]
     station_displayname = stations_config[station_id]["displayname"]
     station_path = output_path / station_slug
-    stations_index[station["state"]].append({
-        "displayname": station_displayname,
-        "slug": station_slug
-    })
-    has_sun = (station_path / "chart_sun.svg").exists()
-    has_daily = (station_path / "chart_temp_daily.svg").exists()
-    has_precip = (station_path / "chart_precip.svg").exists()
-    station_template = jenv.get_template("station.html")
+    has_sun = "sun" in station_charts
+    has_daily = "temp_daily" in station_charts
+    has_precip = "precip" in station_charts
+    has_anomalies = "anomalies" in station_charts
+    page_args = dict(
+        station=station, displayname=station_displayname, slug=station_slug,
+        has_sun=has_sun, has_daily=has_daily, has_precip=has_precip,
+        has_anomalies=has_anomalies, charts=sorted(station_charts),
+        # The anomaly tables are computed against the primary window
+        anomaly_window=climate_windows[0])
 
+    build_manifest = manifest.BuildManifest(station_path)
+    page_hash = page_input_hash("station.html", page_args)
+    if build_manifest.up_to_date("index.html", page_hash):
+        return
+    station_template = jenv.get_template("station.html")
     station_path.mkdir(parents=True, exist_ok=True)
-    open(station_path / "index.html", "w").write(
-        station_template.render(
-            station=station, displayname=station_displayname, slug=station_slug,
-            has_sun=has_sun, has_daily=has_daily, has_precip=has_precip)
-    )
+    open(station_path / "index.html", "w").write(station_template.render(**page_args))
+    build_manifest.record("index.html", page_hash)
+    build_manifest.save()
 
 
-states = [
-    "Burgenland", "Kärnten", "Niederösterreich", "Oberösterreich", "Salzburg", "Steiermark",
-    "Tirol", "Vorarlberg", "Wien"
-]
+def write_pages(charts, region_tables):
+    # charts maps station ids to their drawn charts, region_tables region names to their tables.
+    # Stations without an entry, e.g. because they failed, link the charts of the last build.
+    stations_index = collections.defaultdict(list)
+    for station_id, station in stations_meta.items():
+        stations_index[station["state"]].append({
+            "displayname": stations_config[station_id]["displayname"],
+            "slug": stations_config[station_id]["slug"]
+        })
+        if station_id in charts:
+            write_station_page(station_id, charts[station_id])
+        else:
+            write_station_page(station_id, existing_charts(station_id))
+
+    page_args = dict(stations_index=stations_index, states=states, region_tables=region_tables)
+    build_manifest = manifest.BuildManifest(output_path)
+    page_hash = page_input_hash("list.html", page_args)
+    if not build_manifest.up_to_date("index.html", page_hash):
+        output_path.mkdir(parents=True, exist_ok=True)
+        template = jenv.get_template("list.html")
+        open(output_path / "index.html", "w").write(template.render(**page_args))
+        build_manifest.record("index.html", page_hash)
+        build_manifest.save()
+
+    shutil.copytree("assets", output_path / "assets", dirs_exist_ok=True)
+
+
+def existing_charts(station_id):
+    station_path = output_path / stations_config[station_id]["slug"]
+    return [chart_file.stem.removeprefix("chart_") for chart_file in station_path.glob("chart_*.svg")]
+
+
+def load_region_tables():
+    # State and country tables from climate_tables.py, the list page shows them where present
+    region_tables = {}
+    regions_path = output_path / "regions"
+    if (regions_path / "index.json").exists():
+        for region, table_file in json.load(open(regions_path / "index.json")).items():
+            region_tables[region] = json.load(open(regions_path / table_file))
+    return region_tables
+
+
+def main():
+    write_pages(
+        {station_id: existing_charts(station_id) for station_id in stations_meta},
+        load_region_tables()
+    )
 
-output_path.mkdir(parents=True, exist_ok=True)
-template = jenv.get_template("list.html")
-open(output_path / "index.html", "w").write(
-    template.render(stations_index=stations_index, states=states)
-)
 
-shutil.copytree("assets", output_path / "assets", dirs_exist_ok=True)
+if __name__ == "__main__":
+    main()
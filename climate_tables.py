@@ -1,44 +1,23 @@
 from dataclasses import dataclass
-import configparser
+from typing import Callable
 import datetime
-import statistics
+import functools
 import json
 import collections
+import itertools
 import math
-import pathlib
+import string
 
+import aggregates
 import geosphereapi
-from geosphereapi import make_table
+import manifest
+import parallel
+from geosphereapi import make_table, nan_to_none
+from stations import stations_config, stations_meta, output_path
 
 
-def get_month_multi(dataset, month, series):
-    return [row[series] for row in dataset if row["timestamp"].month == month]
-
-def get_month_scalar(dataset, month, series):
-    results = get_month_multi(dataset, month, series)
-    if len(results) != 1:
-        raise ValueError(f"dataset contains not 1 value for month {month}: {results}")
-    return results[0]
-
-def get_months_scalar(dataset, series):
-    return [
-        get_month_scalar(dataset, month, series)
-        for month in range(1, 13)
-    ]
-
-# ~ def get_months_average(dataset, series, average_func):
-    # ~ return [
-        # ~ average_func(get_month_multi(dataset, month, series))
-        # ~ for month in range(1, 13)
-    # ~ ]
-
-def get_months_average_unreliable(dataset, series, average_func):
-    return [
-        average_func(filter(lambda x: x is not None, get_month_multi(dataset, month, series)))
-        for month in range(1, 13)
-    ]
-
-get_months_average = get_months_average_unreliable
+def round_or_none(x, digits=1):
+    return None if x is None else round(x, digits)
 
 def json_encoder(x):
     if isinstance(x, datetime.date) or isinstance(x, datetime.datetime):
@@ -50,65 +29,113 @@ def json_encoder(x):
 def json_dump(obj, f):
     json.dump(obj, f, indent=2, ensure_ascii=False, default=json_encoder)
 
+def json_dumps(obj):
+    return json.dumps(obj, indent=2, ensure_ascii=False, default=json_encoder)
 
-def make_table_temp(station_monthly):
+
+def make_table_temp(monthly):
     return make_table({
         "month": MONTH_NAMES,
-        "t": get_months_average(station_monthly, "t", statistics.mean),
-        "tmax": get_months_average(station_monthly, "tmax", max),
-        "tmin": get_months_average(station_monthly, "tmin", min),
-        "mtmax": get_months_average(station_monthly, "mtmax", statistics.mean),
-        "mtmin": get_months_average(station_monthly, "mtmin", statistics.mean),
+        "t": monthly.months("t", "mean"),
+        "tmax": monthly.months("tmax", "max"),
+        "tmin": monthly.months("tmin", "min"),
+        "mtmax": monthly.months("mtmax", "mean"),
+        "mtmin": monthly.months("mtmin", "mean"),
     })
 
 
 
-def make_table_climate(station_monthly):
+def make_table_climate(monthly):
     return make_table({
         "month": MONTH_NAMES,
-        "t": get_months_average(station_monthly, "t", statistics.mean),
-        "rsum": get_months_average(station_monthly, "rsum", statistics.mean)
+        "t": monthly.months("t", "mean"),
+        "rsum": monthly.months("rsum", "mean")
     })
 
 
-def make_table_temp_daily(station_daily):
+def make_table_anomalies(monthly):
+    # Every year's monthly mean temperatures as deviations from the window's normals. The year
+    # anomaly is only given for complete years.
+    matrix = monthly.matrix
+    grid = matrix.anomalies("t", monthly.window)
+    year_anomalies = []
+    for row in grid:
+        if any(math.isnan(anomaly) for anomaly in row):
+            year_anomalies.append(None)
+        else:
+            year_anomalies.append(round(math.fsum(row) / 12, 2))
+    return make_table({
+        "year": list(range(matrix.first_year, matrix.first_year + matrix.num_years)),
+        "anomalies": [[round_or_none(anomaly, 2) for anomaly in nan_to_none(row)] for row in grid],
+        "year_anomaly": year_anomalies
+    })
+
+
+def make_table_trend(monthly):
+    # Linear trend of every month over the window's years, per decade. Months with less than
+    # min_coverage of the years have none, few years give unreliable slopes and intervals.
+    series = {"month": MONTH_NAMES}
+    for parameter_name in TREND_PARAMETERS:
+        trends = [
+            (None, None) if month_coverage < min_coverage else trend
+            for trend, month_coverage in zip(monthly.trends(parameter_name), monthly.coverage(parameter_name))
+        ]
+        series[parameter_name + "_slope"] = [
+            None if slope is None else round(slope * 10, 2) for slope, ci in trends
+        ]
+        series[parameter_name + "_ci"] = [None if ci is None else round(ci * 10, 2) for slope, ci in trends]
+    return make_table(series)
+
+
+def make_table_temp_daily(daily):
+    station_daily = daily.station_data
     year_days = (datetime.datetime(last_year + 1, 1, 1) - datetime.datetime(last_year, 1, 1)).days
+    in_year = [year == last_year for year in station_daily.timestamps.years]
     return make_table({
         "day": list(range(0, year_days)),
-        "t": [d["t"] for d in station_daily if d["timestamp"].year == last_year],
-        "tmax": [d["tmax"] for d in station_daily if d["timestamp"].year == last_year],
-        "tmin": [d["tmin"] for d in station_daily if d["timestamp"].year == last_year]
+        "t": nan_to_none(itertools.compress(station_daily.columns["t"], in_year)),
+        "tmax": nan_to_none(itertools.compress(station_daily.columns["tmax"], in_year)),
+        "tmin": nan_to_none(itertools.compress(station_daily.columns["tmin"], in_year))
     })
 
 
-def make_table_temp_freq(station_daily):
-    counters = {name: collections.defaultdict(int) for name in ["t", "tmin", "tmax"]}
-    bucket_size = 5
-    for day in station_daily:
-        for parameter_name in counters.keys():
-            day_value = day[parameter_name]
-            if day_value is None:
-                continue
-            bucket = int(round(day_value)) // bucket_size * bucket_size
-            counters[parameter_name][bucket] += 1
+def make_table_temp_climatology(daily):
+    # Mean and percentile bands of every day of last_year's calendar over all years
+    slots = aggregates.year_day_slots(last_year)
+    series = {"day": list(range(len(slots)))}
+    for parameter_name in ["t", "tmax", "tmin"]:
+        climatology = daily.day_climatology(parameter_name, [p / 100 for p in CLIMATOLOGY_PERCENTILES])
+        series[parameter_name + "_mean"] = [round_or_none(climatology[slot][0]) for slot in slots]
+        for i, p in enumerate(CLIMATOLOGY_PERCENTILES):
+            series[f"{parameter_name}_p{p}"] = [round_or_none(climatology[slot][1][i]) for slot in slots]
+    return make_table(series)
+
+
+def make_table_temp_freq(daily, bucket_size=5, low=-20, high=45):
+    parameter_names = ["t", "tmin", "tmax"]
+    histograms = {
+        parameter_name: daily.histogram(parameter_name, low, high, bucket_size)
+        for parameter_name in parameter_names
+    }
 
     temp_frequency_table = {
         "columns": ["label"],
         "data": []
     }
 
-    for parameter_name in counters.keys():
+    for parameter_name in parameter_names:
         temp_frequency_table["columns"].append(parameter_name + "_count")
         temp_frequency_table["columns"].append(parameter_name + "_perc")
 
-    for bucket_low in range(-20, 45, bucket_size):
+    for bucket_index, bucket_low in enumerate(range(low, high, bucket_size)):
         bucket_label = f"{bucket_low} - {bucket_low + bucket_size - 1}"
         temp_frequency_row = {
             "label": bucket_label
         }
-        for parameter_name in counters.keys():
-            count = round(counters[parameter_name][bucket_low] / num_years, 1)
-            perc = round(counters[parameter_name][bucket_low] / num_days * 100, 1)
+        for parameter_name in parameter_names:
+            bucket_count = histograms[parameter_name][bucket_index]
+            count = round(bucket_count / num_years, 1)
+            perc = round(bucket_count / num_days * 100, 1)
             temp_frequency_row[parameter_name + "_count"] = count
             temp_frequency_row[parameter_name + "_perc"] = perc
         temp_frequency_table["data"].append(temp_frequency_row)
@@ -116,53 +143,58 @@ def make_table_temp_freq(station_daily):
     return temp_frequency_table
 
 
-def make_table_special_days(station_monthly):
+def make_table_special_days(monthly):
     return make_table({
         "month": MONTH_NAMES,
-        "frost": get_months_average(station_monthly, "frost", statistics.mean),
-        "eis": get_months_average(station_monthly, "eis", statistics.mean),
-        "sommer": get_months_average(station_monthly, "sommer", statistics.mean)
+        "frost": monthly.months("frost", "mean"),
+        "eis": monthly.months("eis", "mean"),
+        "sommer": monthly.months("sommer", "mean")
     })
 
 
 
-# ~ heatingdays_counter = collections.defaultdict(int)
-# ~ heatingdegdays_counter = collections.defaultdict(float)
-# ~ for day in station_daily:
-    # ~ if day["t"] < 12.0:
-        # ~ month_index = day["timestamp"].month - 1
-        # ~ heatingdays_counter[month_index] += 1
-        # ~ heatingdegdays_counter[month_index] += 20 - day["t"]
-
-# ~ heatingdays_table = make_table({
-    # ~ "month": MONTH_NAMES,
-    # ~ "heatingdays": [round(heatingdays_counter[m] / num_years, 1) for m in range(12)],
-    # ~ "heatingdegdays": [round(heatingdegdays_counter[m] / num_years, 1) for m in range(12)]
-# ~ })
-def make_table_heatingdays(station_monthly):
+def make_table_heatingdays(monthly):
     return make_table({
         "month": MONTH_NAMES,
-        "ht": get_months_average(station_monthly, "ht", statistics.mean),
-        "gradt": get_months_average(station_monthly, "gradt", statistics.mean)
+        "ht": monthly.months("ht", "mean"),
+        "gradt": monthly.months("gradt", "mean")
     })
 
 
-def make_table_precip(station_monthly):
+def make_table_degree_days(daily):
+    # Yearly average of days beyond the threshold and their degree days per month
+    series = {"month": MONTH_NAMES}
+    for threshold, base in HEATING_LIMITS:
+        results = daily.heating_degree_days("t", threshold, base)
+        series[f"heatingdays_{threshold}"] = [round(days / daily.num_years, 1) for days, degrees in results]
+        series[f"heatingdegdays_{base}_{threshold}"] = [
+            round(degrees / daily.num_years, 1) for days, degrees in results
+        ]
+    for threshold, base in COOLING_LIMITS:
+        results = daily.cooling_degree_days("t", threshold, base)
+        series[f"coolingdays_{threshold}"] = [round(days / daily.num_years, 1) for days, degrees in results]
+        series[f"coolingdegdays_{base}_{threshold}"] = [
+            round(degrees / daily.num_years, 1) for days, degrees in results
+        ]
+    return make_table(series)
+
+
+def make_table_precip(monthly):
     return make_table({
         "month": MONTH_NAMES,
-        "rsum": get_months_average(station_monthly, "rsum", statistics.mean),
-        "rmax": get_months_average(station_monthly, "rmax", max),
-        "festrr": get_months_average(station_monthly, "festrr", statistics.mean),
-        "n1": get_months_average(station_monthly, "n1", statistics.mean),
-        "n10": get_months_average(station_monthly, "n10", statistics.mean)
+        "rsum": monthly.months("rsum", "mean"),
+        "rmax": monthly.months("rmax", "max"),
+        "festrr": monthly.months("festrr", "mean"),
+        "n1": monthly.months("n1", "mean"),
+        "n10": monthly.months("n10", "mean")
     })
 
 
-def make_table_sun(station_monthly):
+def make_table_sun(monthly):
     return make_table({
         "month": MONTH_NAMES,
-        "s": get_months_average(station_monthly, "s", statistics.mean),
-        "global": get_months_average(station_monthly, "global", statistics.mean)
+        "s": monthly.months("s", "mean"),
+        "global": monthly.months("global", "mean")
     })
 
 
@@ -170,9 +202,9 @@ def magnus_formula(t):
     # Return saturation vapor pressure of water in hPa
     return 6.122 * math.exp((17.62*t) / (243.12+t))
 
-def make_table_humid(station_monthly):
-    e_avg = get_months_average(station_monthly, "e", statistics.mean)
-    t_avg = get_months_average(station_monthly, "t", statistics.mean)
+def make_table_humid(monthly):
+    e_avg = monthly.months("e", "mean")
+    t_avg = monthly.months("t", "mean")
     sat_pres_20 = magnus_formula(20)
     equiv20 = []
     for e, t in zip(e_avg, t_avg):
@@ -181,10 +213,10 @@ def make_table_humid(station_monthly):
 
     return make_table({
         "month": MONTH_NAMES,
-        "e": get_months_average(station_monthly, "e", statistics.mean),
-        "rel": get_months_average(station_monthly, "rel", statistics.mean),
-        "rel7": get_months_average(station_monthly, "rel7", statistics.mean),
-        "rel14": get_months_average(station_monthly, "rel14", statistics.mean),
+        "e": monthly.months("e", "mean"),
+        "rel": monthly.months("rel", "mean"),
+        "rel7": monthly.months("rel7", "mean"),
+        "rel14": monthly.months("rel14", "mean"),
         "equiv20": equiv20
     })
 
@@ -199,60 +231,398 @@ end_date = datetime.datetime(last_year + 1, 1, 1, tzinfo=datetime.timezone.utc)
 start_date = datetime.datetime(start_year + 1, 1, 1, tzinfo=datetime.timezone.utc)
 num_days = (end_date - start_date).days
 
-monthly_params = [
-    "t", "tmax", "tmin", "mtmax", "mtmin",
-    "rsum", "rmax", "festrr", "n1", "n10", "s", "global",
-    "frost", "eis", "sommer", "ht", "gradt",
-    "rel", "rel7", "rel14", "e"
-]
-chart_temp_daily_params = ["t", "tmax", "tmin"]
+CLIMATOLOGY_PERCENTILES = [10, 50, 90]
+# (threshold, base) temperatures, e.g. heating degree days 20/12 count 20 - t on days below 12°C
+HEATING_LIMITS = [(12, 20), (15, 18)]
+COOLING_LIMITS = [(18, 18)]
+
+# Parameters and aggregation of the station tables combined into state and country tables
+REGION_PARAMETERS = [("t", "mean"), ("tmax", "max"), ("tmin", "min"), ("rsum", "mean")]
+COUNTRY_NAME = "Österreich"
+# Parameters with monthly trend tables
+TREND_PARAMETERS = ["t", "rsum"]
 
 MONTH_NAMES = ["Jan", "Feb", "Mär", "Apr", "Mai", "Jun", "Jul", "Aug", "Sep", "Okt", "Nov", "Dez"]
 
-stations_config = configparser.ConfigParser()
-stations_config.read_file(open("station_names.ini"))
-stations_meta = json.load(open("stations_meta.json"))
-output_path = pathlib.Path("out")
+fetch_concurrency = geosphereapi.DEFAULT_CONCURRENCY
+# Set to 1 to process stations serially in this process
+process_workers = parallel.DEFAULT_WORKERS
+
+DATASET_MONTHLY = "klima-v1-1m"
+DATASET_DAILY = "klima-v1-1d"
+STATION_DATA_FILES = {
+    DATASET_MONTHLY: "station_monthly.json",
+    DATASET_DAILY: "station_daily.json"
+}
+
+
+@dataclass
+class TableSpec:
+    name: str
+    builder: Callable
+    dataset_name: str
+    parameters: list[str]
+    years: tuple[int, int]
+    # Optional tables are left out when a month has less than min_coverage of its values,
+    # required ones only when a month has no value at all
+    optional: bool = False
+
+
+normal_years = (start_year, last_year)
+# Share of the years in a window that need a value for every month and parameter of a table
+min_coverage = 0.8
+# Monthly tables are written for every window, the first one without a suffix in the file name
+climate_windows = [normal_years, (1991, 2020)]
+monthly_years = (min(start for start, end in climate_windows), max(end for start, end in climate_windows))
+
+TABLE_SPECS = [
+    TableSpec("temp", make_table_temp, DATASET_MONTHLY, ["t", "tmax", "tmin", "mtmax", "mtmin"], monthly_years),
+    TableSpec("climate", make_table_climate, DATASET_MONTHLY, ["t", "rsum"], monthly_years),
+    TableSpec("anomalies", make_table_anomalies, DATASET_MONTHLY, ["t"], monthly_years),
+    TableSpec("trend", make_table_trend, DATASET_MONTHLY, TREND_PARAMETERS, monthly_years),
+    TableSpec("temp_daily", make_table_temp_daily, DATASET_DAILY, ["t", "tmax", "tmin"], (last_year, last_year)),
+    TableSpec(
+        "temp_climatology", make_table_temp_climatology, DATASET_DAILY, ["t", "tmax", "tmin"], normal_years),
+    TableSpec("temp_freq", make_table_temp_freq, DATASET_DAILY, ["t", "tmin", "tmax"], normal_years),
+    TableSpec(
+        "temp_freq_2", functools.partial(make_table_temp_freq, bucket_size=2), DATASET_DAILY,
+        ["t", "tmin", "tmax"], normal_years),
+    TableSpec(
+        "temp_freq_1", functools.partial(make_table_temp_freq, bucket_size=1), DATASET_DAILY,
+        ["t", "tmin", "tmax"], normal_years),
+    # ~ TableSpec("special_days", make_table_special_days, DATASET_MONTHLY, ["frost", "eis", "sommer"], monthly_years),
+    TableSpec("heatingdays", make_table_heatingdays, DATASET_MONTHLY, ["ht", "gradt"], monthly_years),
+    TableSpec("degree_days", make_table_degree_days, DATASET_DAILY, ["t"], normal_years),
+    TableSpec(
+        "precip", make_table_precip, DATASET_MONTHLY, ["rsum", "rmax", "festrr", "n1", "n10"], monthly_years,
+        optional=True),
+    TableSpec("sun", make_table_sun, DATASET_MONTHLY, ["s", "global"], monthly_years, optional=True),
+    TableSpec("humid", make_table_humid, DATASET_MONTHLY, ["e", "t", "rel", "rel7", "rel14"], monthly_years),
+]
+
+# Station metadata flags that tell whether a parameter is measured at all
+PARAMETER_REQUIREMENTS = {
+    "s": "has_sunshine",
+    "global": "has_global_radiation"
+}
 
-for station_meta in stations_meta.values():
-    station_id = station_meta["id"]
-    station_slug = stations_config[station_id]["slug"]
-    station_path = output_path / station_slug
 
-    data_monthly = geosphereapi.get_dataset_year_range(
-        "klima-v1-1m", start_year, last_year, station_id, monthly_params)
-    data_daily = geosphereapi.get_dataset_year_range(
-        "klima-v1-1d", start_year, last_year, station_id, chart_temp_daily_params)
+def parameter_available(station_meta, parameter_name):
+    requirement = PARAMETER_REQUIREMENTS.get(parameter_name)
+    return requirement is None or station_meta[requirement]
 
-    station_monthly = data_monthly.stations[station_id].rows
-    station_daily = data_daily.stations[station_id].rows
 
+def station_tables(station_meta):
+    return [
+        spec for spec in TABLE_SPECS
+        if all(parameter_available(station_meta, name) for name in spec.parameters)
+    ]
+
+
+def plan_requests(station_meta):
+    # Merge the needs of all tables of a station into one request per dataset covering
+    # the union of their parameters and year ranges
+    planned = {}
+    for spec in station_tables(station_meta):
+        if spec.dataset_name not in planned:
+            planned[spec.dataset_name] = (list(spec.parameters), spec.years)
+            continue
+        parameter_names, (start, end) = planned[spec.dataset_name]
+        for name in spec.parameters:
+            if name not in parameter_names:
+                parameter_names.append(name)
+        planned[spec.dataset_name] = (
+            parameter_names, (min(start, spec.years[0]), max(end, spec.years[1])))
+    return planned
+
+
+def plan_jobs(stations_meta):
+    # Stations with identical requests share batches
+    request_groups = collections.defaultdict(list)
+    for station_id, station_meta in stations_meta.items():
+        for dataset_name, (parameter_names, years) in plan_requests(station_meta).items():
+            request_groups[(dataset_name, tuple(parameter_names), years)].append(station_id)
+    jobs = []
+    for (dataset_name, parameter_names, years), station_ids in request_groups.items():
+        jobs.extend(geosphereapi.batch_jobs(dataset_name, station_ids, list(parameter_names), years))
+    return jobs
+
+
+# Transliterations used in the station slugs of station_names.ini, casefold already turns ß into ss
+SLUG_LETTERS = {"ä": "ae", "ö": "oe", "ü": "ue"}
+
+
+def region_slug(name):
+    # Same scheme as the station slugs in station_names.ini
+    return "".join(
+        c if c in string.ascii_letters else SLUG_LETTERS.get(c, "_") for c in name.casefold()
+    )
+
+
+def region_values(monthly, station_meta):
+    # Per month values of the primary window that the regional tables combine, None where the
+    # station lacks the parameter or enough coverage
+    values = {}
+    for parameter_name, aggregation in REGION_PARAMETERS:
+        if not parameter_available(station_meta, parameter_name) or any(
+                month_coverage < min_coverage for month_coverage in monthly.coverage(parameter_name)):
+            values[parameter_name] = None
+        else:
+            values[parameter_name] = monthly.months(parameter_name, aggregation)
+    return values
+
+
+def make_table_region(station_values):
+    # station_values maps station ids to the output of region_values
+    series = {"month": MONTH_NAMES}
+    # Number of stations that went into the values of every parameter
+    station_counts = {}
+    for parameter_name, aggregation in REGION_PARAMETERS:
+        station_ids = [
+            station_id for station_id, values in station_values.items()
+            if values is not None and values[parameter_name] is not None
+        ]
+        station_counts[parameter_name] = len(station_ids)
+        if not station_ids:
+            continue
+        combined = aggregates.combine_stations(
+            [station_values[station_id][parameter_name] for station_id in station_ids],
+            [stations_meta[station_id]["altitude"] for station_id in station_ids]
+        )
+        series[parameter_name + "_mean"] = [round(x, 1) for x in combined["mean"]]
+        series[parameter_name + "_altmean"] = [round(x, 1) for x in combined["weighted"]]
+        series[parameter_name + "_low"] = [round(x, 1) for x in combined["low"]]
+        series[parameter_name + "_high"] = [round(x, 1) for x in combined["high"]]
+    table = make_table(series)
+    table["stations"] = station_counts
+    return table
+
+
+def make_region_tables(station_results):
+    # Returns the tables of every state and the whole country and the table of all station trends
+    # Stations in metadata order, the pool returns them in completion order
+    station_values = {
+        station_id: station_results[station_id]["region"]
+        for station_id in stations_meta
+        if station_id in station_results and station_results[station_id]["region"] is not None
+    }
+    states = collections.defaultdict(dict)
+    for station_id, values in station_values.items():
+        states[stations_meta[station_id]["state"]][station_id] = values
+    states[COUNTRY_NAME] = station_values
+    region_tables = {region: make_table_region(region_values) for region, region_values in states.items()}
+
+    # Trends of all stations side by side
+    trend_rows = []
+    for station_id in stations_meta:
+        if station_id not in station_results or station_results[station_id]["trend"] is None:
+            continue
+        trend_row = {
+            "id": station_id,
+            "name": stations_config[station_id]["displayname"],
+            "state": stations_meta[station_id]["state"],
+            "altitude": stations_meta[station_id]["altitude"]
+        }
+        for column in station_results[station_id]["trend"]["columns"]:
+            if column != "month":
+                trend_row[column] = [row[column] for row in station_results[station_id]["trend"]["data"]]
+        trend_rows.append(trend_row)
+    trend_table = {"columns": list(trend_rows[0].keys()) if trend_rows else [], "data": trend_rows}
+    return region_tables, trend_table
+
+
+def write_region_tables(region_tables, trend_table):
+    # Files are only written when their content changed, the manifest holds the content hashes
+    build_manifest = manifest.BuildManifest(output_path / "regions")
+    # The index maps region names to their table files for the pages
+    regions_index = {}
+    region_files = {}
+    for region, table in region_tables.items():
+        regions_index[region] = f"table_{region_slug(region)}.json"
+        region_files[regions_index[region]] = table
+    region_files["index.json"] = regions_index
+    region_files[f"table_trend_{region_slug(COUNTRY_NAME)}.json"] = trend_table
+
+    build_manifest.path.mkdir(parents=True, exist_ok=True)
+    for file_name, obj in region_files.items():
+        text = json_dumps(obj)
+        content_hash = manifest.content_hash(text)
+        if not build_manifest.up_to_date(file_name, content_hash):
+            open(build_manifest.path / file_name, "w").write(text)
+            build_manifest.record(file_name, content_hash)
+    build_manifest.save()
+
+
+def station_table_plan(station_meta):
+    # (table name, spec, window) of every table of a station, the monthly tables once per window
+    plan = []
+    for window_index, window in enumerate(climate_windows):
+        suffix = "" if window_index == 0 else f"_{window[0]}_{window[1]}"
+        for spec in station_tables(station_meta):
+            # Only the monthly tables depend on the window
+            if window_index > 0 and spec.dataset_name != DATASET_MONTHLY:
+                continue
+            plan.append((spec.name + suffix, spec, window))
+    return plan
+
+
+def dataset_hash(station_data):
+    parts = [repr(station_data.timestamps)]
+    for parameter_name, column in station_data.columns.items():
+        parts += [parameter_name, column.tobytes()]
+    return manifest.content_hash(*parts)
+
+
+def data_hashes(station_datasets):
+    return {dataset_name: dataset_hash(station_data) for dataset_name, station_data in station_datasets.items()}
+
+
+def table_hashes(station_id, station_data_hashes):
+    # Input hash of every planned table from the data, the table settings and the builder code,
+    # computed without building anything
+    # Settings and helpers the builders use, and the JSON writer
+    settings_hash = manifest.content_hash(
+        repr((
+            last_year, num_years, num_days, CLIMATOLOGY_PERCENTILES, HEATING_LIMITS, COOLING_LIMITS,
+            TREND_PARAMETERS, MONTH_NAMES
+        )),
+        repr(min_coverage), manifest.source_hash(aggregates),
+        *[
+            manifest.source_hash(helper)
+            for helper in (round_or_none, magnus_formula, make_table, nan_to_none, json_encoder, json_dump)
+        ]
+    )
+    hashes = {}
+    for table_name, spec, window in station_table_plan(stations_meta[station_id]):
+        hashes[table_name] = manifest.content_hash(
+            settings_hash, station_data_hashes[spec.dataset_name], table_name, repr(window),
+            repr(spec.parameters), repr(spec.optional), manifest.source_hash(spec.builder)
+        )
+    return hashes
+
+
+def outdated_tables(build_manifest, hashes):
+    return [
+        table_name for table_name, input_hash in hashes.items()
+        if not build_manifest.up_to_date(f"table_{table_name}.json", input_hash)
+    ]
+
+
+def build_station_tables(station_id, station_datasets, table_names=None):
+    # Returns the station's tables by file name without the table_ prefix and the values for
+    # the regional tables. table_names limits the tables that are built.
+    # Tables of the same dataset share one set of lazily computed aggregates
+    if DATASET_DAILY in station_datasets:
+        daily = aggregates.DailyAggregates(station_datasets[DATASET_DAILY])
+    monthly_windows = {}
+    if DATASET_MONTHLY in station_datasets:
+        monthly_matrix = aggregates.YearMonthMatrix(station_datasets[DATASET_MONTHLY])
+        monthly_windows = {window: aggregates.MonthlyAggregates(monthly_matrix, window) for window in climate_windows}
+
+    built_tables = {}
+    for table_name, spec, window in station_table_plan(stations_meta[station_id]):
+        if table_names is not None and table_name not in table_names:
+            continue
+        if spec.dataset_name == DATASET_DAILY:
+            built_tables[table_name] = spec.builder(daily)
+            continue
+        monthly = monthly_windows[window]
+        coverage = {name: monthly.coverage(name) for name in spec.parameters}
+        lowest_coverage = min(
+            month_coverage for parameter_coverage in coverage.values() for month_coverage in parameter_coverage
+        )
+        # Additional windows may reach back before a station's first measurement. Required
+        # tables are built with low coverage too, but not for a month without a single value.
+        if lowest_coverage < min_coverage and (
+                spec.optional or window != climate_windows[0] or lowest_coverage == 0):
+            print(f"Station {station_id}: skipping table_{table_name}, coverage below {min_coverage}")
+            continue
+        table = spec.builder(monthly)
+        table["coverage"] = {
+            name: [round(month_coverage, 3) for month_coverage in parameter_coverage]
+            for name, parameter_coverage in coverage.items()
+        }
+        built_tables[table_name] = table
+
+    if DATASET_MONTHLY not in station_datasets:
+        return built_tables, None
+    cache_hits = sum(monthly.hits for monthly in monthly_windows.values())
+    cache_misses = sum(monthly.misses for monthly in monthly_windows.values())
+    print(f"Station {station_id}: aggregate cache {cache_hits} hits, {cache_misses} misses")
+    return built_tables, region_values(monthly_windows[climate_windows[0]], stations_meta[station_id])
+
+
+def write_station_tables(station_datasets, tables, build_manifest, station_data_hashes, hashes):
+    # Writes the station data and the tables whose inputs changed since the last build into the
+    # manifest's directory. Tables that were left out for lack of coverage are removed.
+    station_path = build_manifest.path
     station_path.mkdir(parents=True, exist_ok=True)
 
-    json_dump(station_monthly, open(station_path / "station_monthly.json", "w"))
-    json_dump(station_daily, open(station_path / "station_daily.json", "w"))
-
-    table_temp = make_table_temp(station_monthly)
-    json_dump(table_temp, open(station_path / "table_temp.json", "w"))
-    table_climate = make_table_climate(station_monthly)
-    json_dump(table_climate, open(station_path / "table_climate.json", "w"))
-    table_temp_daily = make_table_temp_daily(station_daily)
-    json_dump(table_temp_daily, open(station_path / "table_temp_daily.json", "w"))
-    table_temp_freq = make_table_temp_freq(station_daily)
-    json_dump(table_temp_freq, open(station_path / "table_temp_freq.json", "w"))
-    #table_special_days = make_table_special_days(station_monthly)
-    #json_dump(table_special_days, open(station_path / "table_special_days.json", "w"))
-    table_heatingdays = make_table_heatingdays(station_monthly)
-    json_dump(table_heatingdays, open(station_path / "table_heatingdays.json", "w"))
-    try:
-        table_precip = make_table_precip(station_monthly)
-        json_dump(table_precip, open(station_path / "table_precip.json", "w"))
-    except statistics.StatisticsError:
-        pass
-    try:
-        table_sun = make_table_sun(station_monthly)
-        json_dump(table_sun, open(station_path / "table_sun.json", "w"))
-    except statistics.StatisticsError:
-        pass
-    table_humid = make_table_humid(station_monthly)
-    json_dump(table_humid, open(station_path / "table_humid.json", "w"))
+    for dataset_name, file_name in STATION_DATA_FILES.items():
+        if dataset_name not in station_datasets:
+            continue
+        if not build_manifest.up_to_date(file_name, station_data_hashes[dataset_name]):
+            json_dump(station_datasets[dataset_name].rows, open(station_path / file_name, "w"))
+            build_manifest.record(file_name, station_data_hashes[dataset_name])
+    for table_name, input_hash in hashes.items():
+        file_name = f"table_{table_name}.json"
+        if build_manifest.up_to_date(file_name, input_hash):
+            continue
+        if table_name in tables:
+            json_dump(tables[table_name], open(station_path / file_name, "w"))
+            build_manifest.record(file_name, input_hash)
+        else:
+            (station_path / file_name).unlink(missing_ok=True)
+            build_manifest.record(file_name, input_hash, written=False)
+
+
+def process_station(station_id, station_datasets):
+    build_manifest = manifest.BuildManifest(output_path / stations_config[station_id]["slug"])
+    station_data_hashes = data_hashes(station_datasets)
+    hashes = table_hashes(station_id, station_data_hashes)
+    # The trend table is always needed for the combined trend table
+    tables, station_region_values = build_station_tables(
+        station_id, station_datasets, set(outdated_tables(build_manifest, hashes)) | {"trend"})
+    write_station_tables(station_datasets, tables, build_manifest, station_data_hashes, hashes)
+    build_manifest.save()
+    return {"region": station_region_values, "trend": tables.get("trend")}
+
+
+def fetch_stations(failures):
+    # Yields the station ids and datasets of all stations as soon as all planned datasets of
+    # a station have arrived. Stations whose data couldn't be fetched are recorded in failures
+    # with the error instead.
+    jobs = plan_jobs(stations_meta)
+    planned_datasets = {
+        station_id: len(plan_requests(station_meta))
+        for station_id, station_meta in stations_meta.items()
+    }
+    pending_data = collections.defaultdict(dict)
+    for job, dataset, error in geosphereapi.get_datasets_concurrent(jobs, fetch_concurrency):
+        dataset_name, batch_station_ids, _, _ = job
+        for station_id in batch_station_ids:
+            if station_id in failures:
+                continue
+            station_error = error
+            if station_error is None and station_id not in dataset.stations:
+                station_error = f"Station missing from the {dataset_name} response\n"
+            if station_error is not None:
+                failures[station_id] = station_error
+                pending_data.pop(station_id, None)
+                continue
+            pending_data[station_id][dataset_name] = dataset.stations[station_id]
+            if len(pending_data[station_id]) == planned_datasets[station_id]:
+                yield station_id, pending_data.pop(station_id)
+
+
+def main():
+    pool = parallel.StationPool(process_workers)
+    fetch_failures = {}
+    for station_id, station_datasets in fetch_stations(fetch_failures):
+        pool.submit(station_id, process_station, station_id, station_datasets)
+    parallel.report_failures(fetch_failures | pool.wait())
+    write_region_tables(*make_region_tables(pool.results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import array
+import datetime
+import json
+import math
+import pathlib
+import threading
+
+
+def to_column(values):
+    return array.array("d", [math.nan if value is None else value for value in values])
+
+def nan_to_none(column):
+    return [None if math.isnan(value) else value for value in column]
+
+
+class DatasetStore:
+    # Local copy of downloaded station data, one file per dataset and station, split into
+    # calendar years. Only years that are over get stored since later ones are still changing.
+    # Columns are float arrays with NaN for missing values while loaded, null in the files.
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.lock = threading.Lock()
+        self.loaded = {}
+
+    def station_file(self, dataset_name, station_id):
+        return self.path / dataset_name / f"{station_id}.json"
+
+    def load(self, dataset_name, station_id):
+        key = (dataset_name, station_id)
+        with self.lock:
+            if key not in self.loaded:
+                station_file = self.station_file(dataset_name, station_id)
+                if station_file.exists():
+                    station_store = json.load(open(station_file))
+                    for year_data in station_store["years"].values():
+                        year_data["columns"] = {
+                            name: to_column(values) for name, values in year_data["columns"].items()
+                        }
+                    self.loaded[key] = station_store
+                else:
+                    self.loaded[key] = {"coordinates": None, "parameters": {}, "years": {}}
+            return self.loaded[key]
+
+    def release(self, dataset_name, station_id):
+        # Loaded stations are kept only until their data has been handed out
+        with self.lock:
+            self.loaded.pop((dataset_name, station_id), None)
+
+    def missing_years(self, dataset_name, station_id, years, parameter_names):
+        stored_years = self.load(dataset_name, station_id)["years"]
+        missing = []
+        for year in years:
+            year_data = stored_years.get(str(year))
+            if year_data is None or not all(name in year_data["columns"] for name in parameter_names):
+                missing.append(year)
+        return missing
+
+    def save_years(self, dataset_name, station_id, coordinates, parameters, year_slices):
+        # year_slices maps year to {"timestamps": [...], "columns": {name: array}}
+        station_store = self.load(dataset_name, station_id)
+        current_year = datetime.date.today().year
+        changed = False
+        with self.lock:
+            station_store["coordinates"] = coordinates
+            station_store["parameters"].update(parameters)
+            for year, year_slice in year_slices.items():
+                if year >= current_year:
+                    continue
+                stored = station_store["years"].get(str(year))
+                if stored is not None and stored["timestamps"] == year_slice["timestamps"]:
+                    stored["columns"].update(year_slice["columns"])
+                else:
+                    station_store["years"][str(year)] = year_slice
+                changed = True
+            if changed:
+                station_file = self.station_file(dataset_name, station_id)
+                station_file.parent.mkdir(parents=True, exist_ok=True)
+                json.dump(
+                    {
+                        **station_store,
+                        "years": {
+                            year: {
+                                "timestamps": year_data["timestamps"],
+                                "columns": {
+                                    name: nan_to_none(column)
+                                    for name, column in year_data["columns"].items()
+                                }
+                            }
+                            for year, year_data in station_store["years"].items()
+                        }
+                    },
+                    open(station_file, "w")
+                )
+
+    def get_years(self, dataset_name, station_id, years):
+        stored_years = self.load(dataset_name, station_id)["years"]
+        return {year: stored_years[str(year)] for year in years if str(year) in stored_years}
@@ -1,36 +1,43 @@
 import datetime
 import json
-import configparser
-import pathlib
 import itertools
 
 import charts
+import manifest
+import parallel
+from stations import stations_config, stations_meta, output_path
 
 
 MONTH_LABELS = ["J", "F", "M", "A", "M", "J", "J", "A", "S", "O", "N", "D"]
-
-def draw_template(data_path, chart_path):
+# Diverging palette from cold to warm for the anomaly charts
+ANOMALY_COLORS = [
+    "#08306B", "#08519C", "#2171B5", "#4292C6", "#6BAED6", "#9ECAE1", "#C6DBEF", "#DEEBF7",
+    "#FEE0D2", "#FCBBA1", "#FC9272", "#FB6A4A", "#EF3B2C", "#CB181D", "#A50F15", "#67000D"
+]
+ANOMALY_STYLE = {
+    f"bin-{i}": {"stroke": "none", "fill": color} for i, color in enumerate(ANOMALY_COLORS)
+}
+# Anomalies in °C that get the outermost colors
+STRIPES_LIMIT = 2
+HEATMAP_LIMIT = 4
+
+def draw_template(table, chart_path):
     chart_style = {}
 
     chart = charts.Chart(charts.merge_styles(charts.default_style, chart_style))
 
-    chart_data = json.load(open(data_path))["data"]
+    chart_data = table["data"]
     labels = MONTH_LABELS
 
-    chart.add_background()
     chart.set_x_edges(charts.calc_edges(len(labels)))
     chart.set_left_scale(charts.Scale(0, 100, 10))
-    chart.draw_subdivisions()
-    chart.draw_baseline()
-    chart.draw_labels_x_between(labels)
-    chart.draw_labels_left()
-    chart.draw_unit_left("°C")
+    chart.draw_axes(labels, "°C")
     chart.add_border()
 
     chart.save(chart_path, pretty=True)
 
 
-def draw_temp(data_path, chart_path):
+def draw_temp(table, chart_path):
     chart_style = {
         "draw-area": {
             "margin-right": 140
@@ -90,7 +97,7 @@ def draw_temp(data_path, chart_path):
 
     chart = charts.Chart(charts.merge_styles(charts.default_style, chart_style))
 
-    chart_data = json.load(open(data_path))["data"]
+    chart_data = table["data"]
     labels = MONTH_LABELS
     series_names = ["t", "tmax", "tmin", "mtmax", "mtmin"]
 
@@ -98,21 +105,16 @@ def draw_temp(data_path, chart_path):
         [r[series_name] for r in chart_data] for series_name in series_names
     ))
 
-    chart.add_background()
     chart.set_x_edges(charts.calc_edges(len(labels)))
     chart.set_left_scale(charts.auto_fit_scale(-20, 40, 10, all_values))
-    chart.draw_subdivisions()
-    chart.draw_baseline()
-    chart.draw_labels_x_between(labels)
-    chart.draw_labels_left()
-    chart.draw_unit_left("°C")
+    chart.draw_axes(labels, "°C")
 
 
-    points = {}
+    points = chart.to_lines(
+        {series_name: [r[series_name] for r in chart_data] for series_name in series_names},
+        "left", "between"
+    )
     for series_name in series_names:
-        series_temp = [r[series_name] for r in chart_data]
-        series_points = chart.to_line(series_temp, "left", "between")
-        points[series_name] = series_points
         chart.add_legend(series_name)
 
     area_max = points["tmax"] + list(reversed(points["mtmax"]))
@@ -131,7 +133,7 @@ def draw_temp(data_path, chart_path):
     chart.save(chart_path, pretty=True)
 
 
-def draw_climate(data_path, chart_path):
+def draw_climate(table, chart_path):
     chart_style = {
         "label-left": {
             "fill": "#B01500"
@@ -164,7 +166,7 @@ def draw_climate(data_path, chart_path):
     }
 
     chart = charts.Chart(charts.merge_styles(charts.default_style, chart_style))
-    chart_data = json.load(open(data_path))["data"]
+    chart_data = table["data"]
     labels = MONTH_LABELS
     rsum_data = [r["rsum"] for r in chart_data]
     t_data = [r["t"] for r in chart_data]
@@ -189,7 +191,7 @@ def draw_climate(data_path, chart_path):
     chart.save(chart_path, pretty=True)
 
 
-def draw_temp_daily(data_path, chart_path):
+def draw_temp_daily(table, chart_path, climatology=None):
     chart_style = {
         "draw-area": {
             "width": 1000,
@@ -229,12 +231,22 @@ def draw_temp_daily(data_path, chart_path):
             "stroke": "none",
             "fill": "#003AE6",
             "fill-opacity": 0.4
+        },
+        "poly-band-outer": {
+            "stroke": "none",
+            "fill": "#808080",
+            "fill-opacity": 0.15
+        },
+        "poly-band-inner": {
+            "stroke": "none",
+            "fill": "#808080",
+            "fill-opacity": 0.3
         }
     }
 
     chart = charts.Chart(charts.merge_styles(charts.default_style, chart_style))
 
-    chart_data = json.load(open(data_path))["data"]
+    chart_data = table["data"]
     labels = MONTH_LABELS
     series_names = ["t", "tmax", "tmin"]
 
@@ -244,6 +256,15 @@ def draw_temp_daily(data_path, chart_path):
     if None in all_values:
         return False
 
+    # Percentile bands of all years, drawn behind the current year
+    band_names = ["tmin_p10", "tmax_p90", "t_p10", "t_p90"]
+    if climatology is not None:
+        climatology_data = climatology["data"]
+        all_values += [
+            r[band_name] for r in climatology_data for band_name in band_names
+            if r[band_name] is not None
+        ]
+
     year = 2022
     year_start = datetime.datetime(year, 1, 1, 0, 0, 0, tzinfo=datetime.timezone.utc)
     year_end = datetime.datetime(year, 12, 31, 23, 59, 59, tzinfo=datetime.timezone.utc)
@@ -255,25 +276,26 @@ def draw_temp_daily(data_path, chart_path):
         month_fraction = month_time / year_time
         month_divisions_pos.append(month_fraction)
 
-    chart.add_background()
     chart.set_x_edges(month_divisions_pos)
     chart.set_left_scale(charts.auto_fit_scale(-20, 40, 10, all_values))
-    chart.draw_subdivisions()
-    chart.draw_baseline()
-    chart.draw_labels_x_between(labels)
-    chart.draw_labels_left()
-    chart.draw_unit_left("°C")
+    chart.draw_axes(labels, "°C")
 
     num_rows = len(chart_data)
-    points = {}
+    if climatology is not None:
+        band_points = chart.lines_from_xy(
+            [i / (num_rows - 1) for i in range(len(climatology_data))],
+            {band_name: [r[band_name] for r in climatology_data] for band_name in band_names},
+            "left"
+        )
+        chart.draw_polygon("band-outer", band_points["tmax_p90"] + list(reversed(band_points["tmin_p10"])))
+        chart.draw_polygon("band-inner", band_points["t_p90"] + list(reversed(band_points["t_p10"])))
+
+    points = chart.lines_from_xy(
+        [i / (num_rows - 1) for i in range(num_rows)],
+        {series_name: [r[series_name] for r in chart_data] for series_name in series_names},
+        "left"
+    )
     for series_name in series_names:
-        series_temp = []
-        for i, r in enumerate(chart_data):
-            val = r[series_name]
-            if val is not None:
-                series_temp.append((i / (num_rows - 1), val))
-        series_points = chart.line_from_xy(series_temp, "left")
-        points[series_name] = series_points
         chart.add_legend(series_name)
 
     area_max = points["tmax"] + list(reversed(points["t"]))
@@ -288,7 +310,69 @@ def draw_temp_daily(data_path, chart_path):
     chart.save(chart_path, pretty=True)
 
 
-def draw_temp_freq(data_path, chart_path):
+def year_labels(years):
+    return [str(year) if year % 10 == 0 else None for year in years]
+
+
+def draw_anomaly_stripes(table, chart_path):
+    chart_style = {
+        "draw-area": {
+            "width": 800,
+            "height": 150,
+            "margin-top": 10,
+            "margin-bottom": 50,
+            "margin-right": 10,
+            "margin-left": 10
+        }
+    }
+    chart_style.update(ANOMALY_STYLE)
+
+    chart = charts.Chart(charts.merge_styles(charts.default_style, chart_style))
+
+    chart_data = table["data"]
+    years = [r["year"] for r in chart_data]
+
+    chart.add_background()
+    chart.set_x_edges(charts.calc_edges(len(years)))
+    chart.set_y_edges([])
+    chart.draw_stripes([r["year_anomaly"] for r in chart_data], STRIPES_LIMIT, len(ANOMALY_COLORS))
+    chart.draw_labels_x_between(year_labels(years))
+
+    chart.save(chart_path, pretty=True)
+
+
+def draw_anomaly_heatmap(table, chart_path):
+    chart_style = {
+        "draw-area": {
+            "width": 800,
+            "height": 300,
+            "margin-top": 10,
+            "margin-bottom": 50,
+            "margin-right": 10,
+            "margin-left": 40
+        }
+    }
+    chart_style.update(ANOMALY_STYLE)
+
+    chart = charts.Chart(charts.merge_styles(charts.default_style, chart_style))
+
+    chart_data = table["data"]
+    years = [r["year"] for r in chart_data]
+    # One row per month, one column per year
+    grid = [[r["anomalies"][month_index] for r in chart_data] for month_index in range(12)]
+
+    chart.add_background()
+    chart.set_x_edges(charts.calc_edges(len(years)))
+    chart.set_y_edges(charts.calc_edges(len(grid)))
+    chart.draw_heatmap(grid, HEATMAP_LIMIT, len(ANOMALY_COLORS))
+    chart.draw_labels_x_between(year_labels(years))
+    chart.draw_labels_y_between(MONTH_LABELS)
+    chart.add_border()
+
+    chart.save(chart_path, pretty=True)
+
+
+def draw_temp_freq(table, chart_path):
     chart_style = {
         "draw-area": {
             "margin-right": 140,
@@ -311,7 +395,7 @@ def draw_temp_freq(data_path, chart_path):
 
     chart = charts.Chart(charts.merge_styles(charts.default_style, chart_style))
 
-    chart_data = json.load(open(data_path))["data"]
+    chart_data = table["data"]
     labels = [r["label"] for r in chart_data]
     tmin_data = [r["tmin_count"] for r in chart_data]
     tmax_data = [r["tmax_count"] for r in chart_data]
@@ -336,7 +420,7 @@ def draw_temp_freq(data_path, chart_path):
     chart.save(chart_path, pretty=True)
 
 
-def draw_heatingdays(data_path, chart_path):
+def draw_heatingdays(table, chart_path):
     chart_style = {
         "draw-area": {
             "margin-right": 150
@@ -374,25 +458,17 @@ def draw_heatingdays(data_path, chart_path):
 
     chart = charts.Chart(charts.merge_styles(charts.default_style, chart_style))
 
-    chart_data = json.load(open(data_path))["data"]
+    chart_data = table["data"]
     labels = MONTH_LABELS
     ht_data = [r["ht"] for r in chart_data]
     gradt_data = [r["gradt"] for r in chart_data]
 
-    chart.add_background()
     chart.set_x_edges(charts.calc_edges(len(labels)))
     chart.set_left_scale(charts.auto_fit_scale(0, 30, 5, ht_data))
     chart.set_right_scale(charts.auto_fit_scale(0, 700, 100, gradt_data))
-    chart.draw_subdivisions()
-    chart.draw_baseline()
-    chart.draw_labels_x_between(labels)
-    chart.draw_labels_left()
-    chart.draw_labels_right()
-    chart.draw_unit_left("Tage")
-    chart.draw_unit_right("Kd")
     chart.add_legend("ht")
     chart.add_legend("gradt")
-    chart.draw_legend()
+    chart.draw_axes(labels, "Tage", "Kd")
 
     chart.draw_bars("ht", ht_data, "left")
     chart.draw_bars("gradt", gradt_data, "right")
@@ -402,7 +478,7 @@ def draw_heatingdays(data_path, chart_path):
     chart.save(chart_path, pretty=True)
 
 
-def draw_sun(data_path, chart_path):
+def draw_sun(table, chart_path):
     chart_style = {
         "draw-area": {
             "margin-right": 180
@@ -439,25 +515,17 @@ def draw_sun(data_path, chart_path):
 
     chart = charts.Chart(charts.merge_styles(charts.default_style, chart_style))
 
-    chart_data = json.load(open(data_path))["data"]
+    chart_data = table["data"]
     labels = MONTH_LABELS
     s_data = [r["s"] for r in chart_data]
     global_data = [r["global"] for r in chart_data]
 
-    chart.add_background()
     chart.set_x_edges(charts.calc_edges(len(labels)))
     chart.set_left_scale(charts.auto_fit_scale(0, 250, 50, s_data))
     chart.set_right_scale(charts.auto_fit_scale(0, 70000, 10000, global_data))
-    chart.draw_subdivisions()
-    chart.draw_baseline()
-    chart.draw_labels_x_between(labels)
-    chart.draw_labels_left()
-    chart.draw_labels_right()
-    chart.draw_unit_left("h")
-    chart.draw_unit_right("J/cm²")
     chart.add_legend("s")
     chart.add_legend("global")
-    chart.draw_legend()
+    chart.draw_axes(labels, "h", "J/cm²")
 
     chart.draw_line("s", chart.to_line(s_data, "left", "between"))
     chart.draw_line("global", chart.to_line(global_data, "right", "between"))
@@ -467,7 +535,7 @@ def draw_sun(data_path, chart_path):
     chart.save(chart_path, pretty=True)
 
 
-def draw_humid(data_path, chart_path):
+def draw_humid(table, chart_path):
     chart_style = {
         "draw-area": {
             "margin-right": 150,
@@ -511,34 +579,29 @@ def draw_humid(data_path, chart_path):
 
     chart = charts.Chart(charts.merge_styles(charts.default_style, chart_style))
 
-    chart_data = json.load(open(data_path))["data"]
+    chart_data = table["data"]
     labels = MONTH_LABELS
 
-    chart.add_background()
+    series_names = ["rel", "rel7", "rel14", "equiv20"]
     chart.set_x_edges(charts.calc_edges(len(labels)))
     chart.set_left_scale(charts.Scale(0, 100, 10))
-    chart.draw_subdivisions()
-    chart.draw_baseline()
-    chart.draw_labels_x_between(labels)
-    chart.draw_labels_left()
-    chart.draw_unit_left("%")
-    chart.add_legend("rel")
-    chart.add_legend("rel7")
-    chart.add_legend("rel14")
-    chart.add_legend("equiv20")
-    chart.draw_legend()
+    for series_name in series_names:
+        chart.add_legend(series_name)
+    chart.draw_axes(labels, "%")
 
-    chart.draw_line("rel", chart.to_line([r["rel"] for r in chart_data], "left", "between"))
-    chart.draw_line("rel7", chart.to_line([r["rel7"] for r in chart_data], "left", "between"))
-    chart.draw_line("rel14", chart.to_line([r["rel14"] for r in chart_data], "left", "between"))
-    chart.draw_line("equiv20", chart.to_line([r["equiv20"] for r in chart_data], "left", "between"))
+    points = chart.to_lines(
+        {series_name: [r[series_name] for r in chart_data] for series_name in series_names},
+        "left", "between"
+    )
+    for series_name in series_names:
+        chart.draw_line(series_name, points[series_name])
 
     chart.add_border()
 
     chart.save(chart_path, pretty=True)
 
 
-def draw_precip(data_path, chart_path):
+def draw_precip(table, chart_path):
     chart_style = {
         "draw-area": {
             "margin-right": 140
@@ -578,25 +641,20 @@ def draw_precip(data_path, chart_path):
 
     chart = charts.Chart(charts.merge_styles(charts.default_style, chart_style))
 
-    chart_data = json.load(open(data_path))["data"]
+    chart_data = table["data"]
     labels = MONTH_LABELS
     rsum_data = [r["rsum"] for r in chart_data]
     festrr_data = [r["festrr"] for r in chart_data]
 
-    chart.add_background()
     chart.set_x_edges(charts.calc_edges(len(labels)))
     chart.set_left_scale(charts.auto_fit_scale(0, 200, 20, rsum_data + festrr_data))
-    chart.draw_subdivisions()
-    chart.draw_baseline()
-    chart.draw_labels_x_between(labels)
-    chart.draw_labels_left()
-    chart.draw_unit_left("mm")
     chart.add_legend("rsum")
     chart.add_legend("festrr")
-    chart.draw_legend()
+    chart.draw_axes(labels, "mm")
 
-    rsum_points = chart.to_stepped_line(rsum_data, "left")
-    festrr_points = chart.to_stepped_line(festrr_data, "left")
+    points = chart.to_stepped_lines({"rsum": rsum_data, "festrr": festrr_data}, "left")
+    rsum_points = points["rsum"]
+    festrr_points = points["festrr"]
     chart.draw_polygon("rsum", rsum_points + list(reversed(festrr_points)))
     chart.draw_polygon("festrr", festrr_points + list(reversed(chart.baseline_points())))
     chart.draw_line("rsum", rsum_points)
@@ -607,24 +665,116 @@ def draw_precip(data_path, chart_path):
     chart.save(chart_path, pretty=True)
 
 
-stations_config = configparser.ConfigParser()
-stations_config.read_file(open("station_names.ini"))
-stations_meta = json.load(open("stations_meta.json"))
-output_path = pathlib.Path("out")
+# Set to 1 to draw stations serially in this process
+process_workers = parallel.DEFAULT_WORKERS
+
+# Chart name, drawing function and the tables it is drawn from. Charts are left out when their
+# first table is missing, the following tables are passed as None then.
+STATION_CHARTS = [
+    ("temp", draw_temp, ["temp"]),
+    ("climate", draw_climate, ["climate"]),
+    ("stripes", draw_anomaly_stripes, ["anomalies"]),
+    ("anomalies", draw_anomaly_heatmap, ["anomalies"]),
+    ("temp_daily", draw_temp_daily, ["temp_daily", "temp_climatology"]),
+    ("temp_freq", draw_temp_freq, ["temp_freq"]),
+    ("heatingdays", draw_heatingdays, ["heatingdays"]),
+    ("sun", draw_sun, ["sun"]),
+    ("humid", draw_humid, ["humid"]),
+    ("precip", draw_precip, ["precip"]),
+]
+
+
+def draw_station_charts(station_path, tables, chart_names=None):
+    # tables maps table names to the station's tables, returns the names of the drawn charts.
+    # chart_names limits the charts that are drawn.
+    station_path.mkdir(parents=True, exist_ok=True)
+    drawn = []
+    for chart_name, draw, table_names in STATION_CHARTS:
+        if chart_names is not None and chart_name not in chart_names:
+            continue
+        if table_names[0] not in tables:
+            continue
+        chart_tables = [tables.get(table_name) for table_name in table_names]
+        if draw(chart_tables[0], station_path / f"chart_{chart_name}.svg", *chart_tables[1:]) is not False:
+            drawn.append(chart_name)
+    return drawn
+
+
+def chart_hashes(table_hashes):
+    # Input hash of every chart from the hashes of its tables, the code of its drawing function,
+    # which holds its style, of the chart module and of the settings and helpers the drawing
+    # functions share
+    settings_hash = manifest.content_hash(
+        repr((MONTH_LABELS, ANOMALY_COLORS, ANOMALY_STYLE, STRIPES_LIMIT, HEATMAP_LIMIT)),
+        manifest.source_hash(year_labels)
+    )
+    hashes = {}
+    for chart_name, draw, table_names in STATION_CHARTS:
+        if table_names[0] not in table_hashes:
+            continue
+        hashes[chart_name] = manifest.content_hash(
+            settings_hash, manifest.source_hash(draw), manifest.source_hash(charts),
+            *[table_hashes.get(table_name, "") for table_name in table_names]
+        )
+    return hashes
+
+
+def outdated_charts(build_manifest, hashes):
+    return [
+        chart_name for chart_name, input_hash in hashes.items()
+        if not build_manifest.up_to_date(f"chart_{chart_name}.svg", input_hash)
+    ]
+
+
+def chart_tables(chart_names):
+    # Names of the tables needed to draw the charts
+    return {
+        table_name for chart_name, draw, table_names in STATION_CHARTS if chart_name in chart_names
+        for table_name in table_names
+    }
 
-for station_meta in stations_meta.values():
-    station_id = station_meta["id"]
-    station_slug = stations_config[station_id]["slug"]
-    station_path = output_path / station_slug
 
-    station_path.mkdir(parents=True, exist_ok=True)
-    draw_temp(station_path / "table_temp.json", station_path / "chart_temp.svg")
-    draw_climate(station_path / "table_climate.json", station_path / "chart_climate.svg")
-    draw_temp_daily(station_path / "table_temp_daily.json", station_path / "chart_temp_daily.svg")
-    draw_temp_freq(station_path / "table_temp_freq.json", station_path / "chart_temp_freq.svg")
-    draw_heatingdays(station_path / "table_heatingdays.json", station_path / "chart_heatingdays.svg")
-    if (station_path / "table_sun.json").exists():
-        draw_sun(station_path / "table_sun.json", station_path / "chart_sun.svg")
-    draw_humid(station_path / "table_humid.json", station_path / "chart_humid.svg")
-    if (station_path / "table_precip.json").exists():
-        draw_precip(station_path / "table_precip.json", station_path / "chart_precip.svg")
+def update_charts(build_manifest, hashes, chart_names, tables):
+    # Draws the given outdated charts into the manifest's directory and returns the names of
+    # all charts that exist for the current inputs
+    drawn = draw_station_charts(build_manifest.path, tables, chart_names)
+    for chart_name in chart_names:
+        if chart_name not in drawn:
+            (build_manifest.path / f"chart_{chart_name}.svg").unlink(missing_ok=True)
+        build_manifest.record(f"chart_{chart_name}.svg", hashes[chart_name], chart_name in drawn)
+    return [chart_name for chart_name in hashes if build_manifest.written(f"chart_{chart_name}.svg")]
+
+
+def draw_station(station_id):
+    station_path = output_path / stations_config[station_id]["slug"]
+    build_manifest = manifest.BuildManifest(station_path)
+    # climate_tables.py records the input hashes of the tables it writes and of those it left
+    # out, so charts of left out tables are outdated and get removed
+    table_hashes = {}
+    for table_name in chart_tables([chart_name for chart_name, draw, table_names in STATION_CHARTS]):
+        table_path = station_path / f"table_{table_name}.json"
+        if build_manifest.input_hash(table_path.name) is not None:
+            table_hashes[table_name] = build_manifest.input_hash(table_path.name)
+        elif table_path.exists():
+            table_hashes[table_name] = manifest.file_hash(table_path)
+    hashes = chart_hashes(table_hashes)
+    chart_names = outdated_charts(build_manifest, hashes)
+    tables = {}
+    for table_name in chart_tables(chart_names):
+        table_path = station_path / f"table_{table_name}.json"
+        if table_name in table_hashes and table_path.exists():
+            tables[table_name] = json.load(open(table_path))
+    station_charts = update_charts(build_manifest, hashes, chart_names, tables)
+    build_manifest.save()
+    return station_charts
+
+
+def main():
+    pool = parallel.StationPool(process_workers)
+    for station_id in stations_meta.keys():
+        pool.submit(station_id, draw_station, station_id)
+    parallel.report_failures(pool.wait())
+
+
+if __name__ == "__main__":
+    main()
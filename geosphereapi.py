@@ -1,10 +1,22 @@
 from dataclasses import dataclass
+import array
+import bisect
+import calendar
+import collections
+import concurrent.futures
 import datetime
+import functools
 import itertools
+import math
+import traceback
 
 import requests
+import requests.adapters
 import requests_cache
 
+import datastore
+import jsonstream
+
 # ~ import logging
 # ~ logging.basicConfig()
 # ~ logging.getLogger().setLevel(logging.DEBUG)
@@ -12,13 +24,162 @@ import requests_cache
 # ~ requests_log.setLevel(logging.DEBUG)
 # ~ requests_log.propagate = True
 
+# Streamed dataset requests use a plain session, created before the URL cache patches
+# requests.Session. The cache reads every body into memory to store it, the DatasetStore keeps
+# the downloaded data instead.
+stream_session = requests.Session()
 requests_cache.install_cache("requests")
 session = requests.Session()
+# Set to None to always download the full year range
+store = datastore.DatasetStore("store")
+
+API_URL = "https://dataset.api.hub.zamg.ac.at/v1/station/historical"
+DEFAULT_CONCURRENCY = 8
+# Limits for grouping stations into one request, see plan_station_batches
+MAX_REQUEST_VALUES = 1_000_000
+MAX_URL_LENGTH = 2000
+# Parse responses chunk by chunk instead of decoding the whole body with resp.json()
+stream_responses = True
+STREAM_CHUNK_SIZE = 64 * 1024
+STEPS_PER_YEAR = {"1m": 12, "1d": 366, "1h": 366 * 24, "10min": 366 * 24 * 6}
+# Status codes the API answers with when a request asks for too much data
+SIZE_LIMIT_STATUS_CODES = {400, 413, 422}
+
+ONE_DAY = datetime.timedelta(days=1)
+
+def add_months(timestamp, months):
+    month_index = timestamp.month - 1 + months
+    return timestamp.replace(year=timestamp.year + month_index // 12, month=month_index % 12 + 1)
+
+def day_of_year(date):
+    return date.timetuple().tm_yday
+
+class Timestamps:
+    # Common interface of the timestamp column. Iterating yields datetimes, the calendar fields
+    # are integer arrays with one entry per timestamp.
+
+    @functools.cached_property
+    def years(self):
+        return self.calendar_fields()[0]
+
+    @functools.cached_property
+    def months(self):
+        return self.calendar_fields()[1]
+
+    @functools.cached_property
+    def days_of_year(self):
+        return self.calendar_fields()[2]
+
+@dataclass
+class ExplicitTimestamps(Timestamps):
+    timestamps: list[datetime.datetime]
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __iter__(self):
+        return iter(self.timestamps)
+
+    def calendar_fields(self):
+        return (
+            array.array("h", [t.year for t in self.timestamps]),
+            array.array("h", [t.month for t in self.timestamps]),
+            array.array("h", [day_of_year(t) for t in self.timestamps])
+        )
+
+@dataclass
+class MonthlyTimestamps(Timestamps):
+    # One timestamp at the start of every month
+    start: datetime.datetime
+    count: int
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (add_months(self.start, i) for i in range(self.count))
+
+    def calendar_fields(self):
+        month_indices = range(self.start.month - 1, self.start.month - 1 + self.count)
+        years = array.array("h", [self.start.year + i // 12 for i in month_indices])
+        months = array.array("h", [i % 12 + 1 for i in month_indices])
+        month_start_days = {
+            leap: [day_of_year(datetime.date(2000 if leap else 2001, m, 1)) for m in range(1, 13)]
+            for leap in (False, True)
+        }
+        days_of_year = array.array("h", [
+            month_start_days[calendar.isleap(year)][month - 1]
+            for year, month in zip(years, months)
+        ])
+        return years, months, days_of_year
+
+@dataclass
+class RegularTimestamps(Timestamps):
+    # Fixed step that divides a day evenly, starting at midnight
+    start: datetime.datetime
+    step: datetime.timedelta
+    count: int
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return (self.start + self.step * i for i in range(self.count))
+
+    def calendar_fields(self):
+        per_day = ONE_DAY // self.step
+        years = array.array("h")
+        months = array.array("h")
+        days_of_year = array.array("h")
+        date = self.start.date()
+        remaining = self.count
+        # Work in runs of whole months, the fields are constant or counting up within them
+        while remaining > 0:
+            month_days = calendar.monthrange(date.year, date.month)[1] - date.day + 1
+            run_days = min(month_days, -(-remaining // per_day))
+            run_length = min(run_days * per_day, remaining)
+            years.extend(array.array("h", [date.year]) * run_length)
+            months.extend(array.array("h", [date.month]) * run_length)
+            first_day = day_of_year(date)
+            if per_day == 1:
+                days_of_year.extend(array.array("h", range(first_day, first_day + run_length)))
+            else:
+                days_of_year.extend(array.array("h", [
+                    first_day + i // per_day for i in range(run_length)
+                ]))
+            remaining -= run_length
+            date += ONE_DAY * run_days
+        return years, months, days_of_year
+
+def parse_timestamps(timestamp_strs):
+    # Only the first, second and last timestamp are parsed when they form a regular grid
+    count = len(timestamp_strs)
+    if count >= 2:
+        start = datetime.datetime.fromisoformat(timestamp_strs[0])
+        second = datetime.datetime.fromisoformat(timestamp_strs[1])
+        last = datetime.datetime.fromisoformat(timestamp_strs[-1])
+        midnight = start.replace(hour=0, minute=0, second=0, microsecond=0)
+        if start == midnight and start.day == 1 and second == add_months(start, 1):
+            if last == add_months(start, count - 1):
+                return MonthlyTimestamps(start, count)
+        step = second - start
+        if step > datetime.timedelta(0) and ONE_DAY % step == datetime.timedelta(0) and start == midnight:
+            if last == start + step * (count - 1):
+                return RegularTimestamps(start, step, count)
+    return ExplicitTimestamps([datetime.datetime.fromisoformat(d) for d in timestamp_strs])
 
 @dataclass
 class StationData:
     coordinates: tuple[float, float]
-    rows: list[dict]
+    timestamps: Timestamps
+    # One float array per parameter, missing values are NaN
+    columns: dict[str, array.array]
+
+    @functools.cached_property
+    def rows(self):
+        series = {name: nan_to_none(column) for name, column in self.columns.items()}
+        series["timestamp"] = self.timestamps
+        return make_table(series)["data"]
 
 @dataclass
 class ParameterInfo:
@@ -41,23 +202,33 @@ def make_table(series):
     ]
     return {"columns": columns, "data": rows}
 
-def get_dataset(dataset_name, start, end, station_id, parameter_names):
-    print(f"Requesting {dataset_name} from {start} to {end}, station {station_id}, parameters {parameter_names}")
-    resp = session.get(
-        f"https://dataset.api.hub.zamg.ac.at/v1/station/historical/{dataset_name}",
+def to_column(values):
+    return array.array("d", [math.nan if value is None else value for value in values])
+
+def nan_to_none(column):
+    return [None if math.isnan(value) else value for value in column]
+
+def get_dataset(dataset_name, start, end, station_ids, parameter_names):
+    if isinstance(station_ids, str):
+        station_ids = [station_ids]
+    print(f"Requesting {dataset_name} from {start} to {end}, stations {station_ids}, parameters {parameter_names}")
+    dataset_session = stream_session if stream_responses else session
+    resp = dataset_session.get(
+        f"{API_URL}/{dataset_name}",
         params={
             "parameters": ",".join(parameter_names),
             "start": start.strftime("%Y-%m-%dT%H:%M"),
             "end": end.strftime("%Y-%m-%dT%H:%M"),
-            "station_ids": station_id
-        }
+            "station_ids": ",".join(station_ids)
+        },
+        stream=stream_responses
     )
+    resp.raise_for_status()
     assert resp.headers["Content-Type"] == "application/json"
+    if stream_responses:
+        return parse_response_stream(resp.iter_content(STREAM_CHUNK_SIZE), parameter_names)
     resp_data = resp.json()
-    native_timestamps = [
-        datetime.datetime.fromisoformat(d)
-        for d in resp_data["timestamps"]
-    ]
+    native_timestamps = parse_timestamps(resp_data["timestamps"])
     parameters = [
         ParameterInfo(
             name = param_name,
@@ -70,20 +241,241 @@ def get_dataset(dataset_name, start, end, station_id, parameter_names):
     for feature in resp_data["features"]:
         coordinates = feature["geometry"]["coordinates"]
         station_id = feature["properties"]["station"]
-        param_series = {
-            param_name: feature["properties"]["parameters"][param_name]["data"]
+        columns = {
+            param_name: to_column(feature["properties"]["parameters"][param_name]["data"])
             for param_name in parameter_names
         }
-        param_series["timestamp"] = native_timestamps
-        rows = make_table(param_series)["data"]
-        stations[station_id] = StationData(coordinates, rows)
+        stations[station_id] = StationData(coordinates, native_timestamps, columns)
+
+    return StationDataset(parameters, stations)
+
+def parse_response_stream(chunks, parameter_names):
+    # Decodes the timestamps and every feature's parameter data arrays directly into columns
+    timestamp_strs = []
+    features = []
+    parameter_fields = collections.defaultdict(dict)
+
+    def get_feature(index):
+        while len(features) <= index:
+            features.append({
+                "station": None,
+                "coordinates": [],
+                "columns": {name: array.array("d") for name in parameter_names}
+            })
+        return features[index]
+
+    def column_sink(column):
+        return lambda values: column.extend(to_column(values))
+
+    def array_sink(path):
+        if path == ("timestamps",):
+            return timestamp_strs.extend
+        if len(path) == 4 and path[0] == "features" and path[2:] == ("geometry", "coordinates"):
+            return get_feature(path[1])["coordinates"].extend
+        if (len(path) == 6 and path[0] == "features" and path[2:4] == ("properties", "parameters")
+                and path[5] == "data"):
+            columns = get_feature(path[1])["columns"]
+            if path[4] in columns:
+                return column_sink(columns[path[4]])
+            return lambda values: None
+        return None
 
+    def on_value(path, value):
+        if len(path) == 4 and path[0] == "features" and path[2:] == ("properties", "station"):
+            get_feature(path[1])["station"] = value
+        elif (len(path) == 6 and path[0] == "features" and path[2:4] == ("properties", "parameters")
+                and path[5] in ("name", "unit")):
+            parameter_fields[path[4]].setdefault(path[5], value)
+
+    parser = jsonstream.StreamParser(array_sink, on_value)
+    for chunk in chunks:
+        parser.feed(chunk)
+    parser.close()
+
+    native_timestamps = parse_timestamps(timestamp_strs)
+    parameters = [
+        ParameterInfo(
+            name = param_name,
+            description = parameter_fields[param_name]["name"],
+            unit = parameter_fields[param_name]["unit"]
+        )
+        for param_name in parameter_names
+    ]
+    stations = {}
+    for feature in features:
+        stations[feature["station"]] = StationData(
+            feature["coordinates"], native_timestamps, feature["columns"])
     return StationDataset(parameters, stations)
 
-def get_dataset_year_range(dataset_name, start, end, station_id, parameter_names):
+def fetch_dataset_year_range(dataset_name, start, end, station_ids, parameter_names):
     year_start = datetime.datetime(start, 1, 1, 0, 0, 0)
     year_end = datetime.datetime(end, 12, 31, 23, 59, 59)
-    return get_dataset(dataset_name, year_start, year_end, station_id, parameter_names)
+    return get_dataset(dataset_name, year_start, year_end, station_ids, parameter_names)
+
+def split_years(station_data):
+    # Split into the {"timestamps": [...], "columns": {...}} slices the dataset store holds
+    years = station_data.timestamps.years
+    timestamp_strs = [t.isoformat(timespec="minutes") for t in station_data.timestamps]
+    year_slices = {}
+    slice_start = 0
+    while slice_start < len(years):
+        year = years[slice_start]
+        slice_end = bisect.bisect_right(years, year, lo=slice_start)
+        year_slices[year] = {
+            "timestamps": timestamp_strs[slice_start:slice_end],
+            "columns": {
+                name: column[slice_start:slice_end]
+                for name, column in station_data.columns.items()
+            }
+        }
+        slice_start = slice_end
+    return year_slices
+
+def join_years(coordinates, year_slices, parameter_names):
+    timestamp_strs = []
+    columns = {name: array.array("d") for name in parameter_names}
+    for year in sorted(year_slices):
+        timestamp_strs.extend(year_slices[year]["timestamps"])
+        for name in parameter_names:
+            columns[name].extend(year_slices[year]["columns"][name])
+    return StationData(coordinates, parse_timestamps(timestamp_strs), columns)
+
+def year_runs(years):
+    # Group years into contiguous (start, end) ranges
+    runs = []
+    for year in sorted(years):
+        if runs and runs[-1][1] == year - 1:
+            runs[-1][1] = year
+        else:
+            runs.append([year, year])
+    return [tuple(run) for run in runs]
+
+def get_dataset_year_range(dataset_name, start, end, station_ids, parameter_names):
+    if store is None:
+        return fetch_dataset_year_range(dataset_name, start, end, station_ids, parameter_names)
+    if isinstance(station_ids, str):
+        station_ids = [station_ids]
+
+    years = range(start, end + 1)
+    missing = {
+        station_id: set(store.missing_years(dataset_name, station_id, years, parameter_names))
+        for station_id in station_ids
+    }
+    fetched = {station_id: {} for station_id in station_ids}
+    coordinates = {}
+    parameters = None
+    for run_start, run_end in year_runs(set().union(*missing.values())):
+        run_station_ids = [
+            station_id for station_id in station_ids
+            if any(run_start <= year <= run_end for year in missing[station_id])
+        ]
+        dataset = fetch_dataset_year_range(
+            dataset_name, run_start, run_end, run_station_ids, parameter_names)
+        parameters = dataset.parameters
+        parameters_stored = {
+            info.name: {"description": info.description, "unit": info.unit}
+            for info in dataset.parameters
+        }
+        for station_id, station_data in dataset.stations.items():
+            year_slices = split_years(station_data)
+            fetched.setdefault(station_id, {}).update(year_slices)
+            coordinates[station_id] = station_data.coordinates
+            store.save_years(
+                dataset_name, station_id, station_data.coordinates, parameters_stored, year_slices)
+
+    stations = {}
+    for station_id in station_ids:
+        year_slices = store.get_years(dataset_name, station_id, years)
+        year_slices.update(fetched[station_id])
+        if station_id not in coordinates:
+            coordinates[station_id] = store.load(dataset_name, station_id)["coordinates"]
+        stations[station_id] = join_years(coordinates[station_id], year_slices, parameter_names)
+    if parameters is None:
+        parameters_stored = store.load(dataset_name, station_ids[0])["parameters"]
+        parameters = [
+            ParameterInfo(name, parameters_stored[name]["description"], parameters_stored[name]["unit"])
+            for name in parameter_names
+        ]
+    for station_id in station_ids:
+        store.release(dataset_name, station_id)
+    return StationDataset(parameters, stations)
+
+def estimate_values(dataset_name, start, end, parameter_names):
+    # Upper bound of values one station contributes to a response
+    resolution = dataset_name.rsplit("-", 1)[-1]
+    steps = (end - start + 1) * STEPS_PER_YEAR.get(resolution, STEPS_PER_YEAR["10min"])
+    return steps * len(parameter_names)
+
+def plan_station_batches(dataset_name, start, end, station_ids, parameter_names):
+    values_per_station = estimate_values(dataset_name, start, end, parameter_names)
+    max_stations = max(1, MAX_REQUEST_VALUES // values_per_station)
+    base_url_length = (
+        len(f"{API_URL}/{dataset_name}?parameters=&start=YYYY-mm-ddTHH%3AMM&end=YYYY-mm-ddTHH%3AMM&station_ids=")
+        + sum(len(name) + 3 for name in parameter_names)
+    )
+
+    batches = []
+    batch = []
+    url_length = base_url_length
+    for station_id in station_ids:
+        # Commas are sent url encoded as %2C
+        id_length = len(station_id) + 3
+        if batch and (len(batch) >= max_stations or url_length + id_length > MAX_URL_LENGTH):
+            batches.append(batch)
+            batch = []
+            url_length = base_url_length
+        batch.append(station_id)
+        url_length += id_length
+    if batch:
+        batches.append(batch)
+    return batches
+
+def get_dataset_batch(dataset_name, start, end, station_ids, parameter_names):
+    # Fetch several stations with one request, halving the batch if the API rejects it as too large
+    if isinstance(station_ids, str):
+        station_ids = [station_ids]
+    try:
+        return get_dataset_year_range(dataset_name, start, end, station_ids, parameter_names)
+    except requests.HTTPError as e:
+        if len(station_ids) == 1 or e.response.status_code not in SIZE_LIMIT_STATUS_CODES:
+            raise
+    middle = len(station_ids) // 2
+    dataset = get_dataset_batch(dataset_name, start, end, station_ids[:middle], parameter_names)
+    dataset_rest = get_dataset_batch(dataset_name, start, end, station_ids[middle:], parameter_names)
+    dataset.stations.update(dataset_rest.stations)
+    return dataset
+
+def batch_jobs(dataset_name, station_ids, parameter_names, year_range):
+    start, end = year_range
+    return [
+        (dataset_name, batch, parameter_names, year_range)
+        for batch in plan_station_batches(dataset_name, start, end, station_ids, parameter_names)
+    ]
+
+def configure_connection_pool(max_connections):
+    # One pooled connection per worker thread, all to the same API host
+    for pooled_session in (session, stream_session):
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        pooled_session.mount("https://", adapter)
+
+def get_datasets_concurrent(jobs, max_workers=DEFAULT_CONCURRENCY):
+    # jobs are (dataset_name, station_ids, parameter_names, (start_year, end_year)) tuples,
+    # results are yielded as (job, StationDataset, None) in completion order. A failing job
+    # doesn't stop the others, it is yielded as (job, None, traceback text).
+    configure_connection_pool(max_workers)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for job in jobs:
+            dataset_name, station_ids, parameter_names, (start, end) = job
+            future = executor.submit(
+                get_dataset_batch, dataset_name, start, end, station_ids, parameter_names)
+            futures[future] = job
+        for future in concurrent.futures.as_completed(futures):
+            e = future.exception()
+            if e is not None:
+                yield futures[future], None, "".join(traceback.format_exception(e))
+            else:
+                yield futures[future], future.result(), None
 
 def get_metadata(dataset_name):
     resp = session.get(f"https://dataset.api.hub.zamg.ac.at/v1/station/historical/{dataset_name}/metadata")
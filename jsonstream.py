@@ -0,0 +1,112 @@
+import codecs
+import json
+import re
+
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+STRING = re.compile(r'"(?:[^"\\]|\\.)*"')
+SCALAR = re.compile(r"[^,:\]}\s]+")
+
+
+class StreamParser:
+    # Incremental JSON scanner for documents that arrive in chunks. It never builds the document
+    # tree. Scalar values are passed to on_value(path, value). For each array, array_sink(path)
+    # can return a function that receives the array contents piecewise as lists; such arrays
+    # must be flat and contain no strings with commas or brackets. Everything else is scanned
+    # and dropped. A path is a tuple of object keys and array indices.
+
+    def __init__(self, array_sink, on_value):
+        self.array_sink = array_sink
+        self.on_value = on_value
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        # Frames are [is_object, key or index, expecting key]
+        self.stack = []
+        self.sink = None
+
+    def feed(self, chunk):
+        self.buffer = self.buffer[self.pos:] + self.decoder.decode(chunk)
+        self.pos = 0
+        self.parse(final=False)
+
+    def close(self):
+        self.buffer = self.buffer[self.pos:] + self.decoder.decode(b"", final=True)
+        self.pos = 0
+        self.parse(final=True)
+        if self.stack or self.sink is not None or self.buffer[self.pos:].strip():
+            raise ValueError("Incomplete JSON document")
+
+    def path(self):
+        return tuple(frame[1] for frame in self.stack)
+
+    def parse(self, final):
+        buffer = self.buffer
+        while True:
+            if self.sink is not None:
+                if not self.parse_flat_array():
+                    return
+                continue
+            self.pos = WHITESPACE.match(buffer, self.pos).end()
+            if self.pos >= len(buffer):
+                return
+            char = buffer[self.pos]
+            if char == ",":
+                frame = self.stack[-1]
+                if frame[0]:
+                    frame[2] = True
+                else:
+                    frame[1] += 1
+                self.pos += 1
+            elif char == ":":
+                self.stack[-1][2] = False
+                self.pos += 1
+            elif char == "{":
+                self.stack.append([True, None, True])
+                self.pos += 1
+            elif char == "[":
+                sink = self.array_sink(self.path())
+                if sink is None:
+                    self.stack.append([False, 0, False])
+                else:
+                    self.sink = sink
+                self.pos += 1
+            elif char in "}]":
+                self.stack.pop()
+                self.pos += 1
+            elif char == '"':
+                match = STRING.match(buffer, self.pos)
+                if match is None:
+                    if final:
+                        raise ValueError("Unterminated string")
+                    return
+                value = json.loads(match.group())
+                self.pos = match.end()
+                if self.stack and self.stack[-1][0] and self.stack[-1][2]:
+                    self.stack[-1][1] = value
+                else:
+                    self.on_value(self.path(), value)
+            else:
+                match = SCALAR.match(buffer, self.pos)
+                if match is None:
+                    raise ValueError(f"Unexpected character {char!r}")
+                if match.end() == len(buffer) and not final:
+                    # The value might continue in the next chunk
+                    return
+                self.on_value(self.path(), json.loads(match.group()))
+                self.pos = match.end()
+
+    def parse_flat_array(self):
+        # Returns True once the closing bracket was consumed
+        end = self.buffer.find("]", self.pos)
+        if end == -1:
+            cut = self.buffer.rfind(",", self.pos)
+            if cut == -1:
+                return False
+            self.sink(json.loads("[" + self.buffer[self.pos:cut] + "]"))
+            self.pos = cut + 1
+            return False
+        self.sink(json.loads("[" + self.buffer[self.pos:end] + "]"))
+        self.pos = end + 1
+        self.sink = None
+        return True
@@ -0,0 +1,72 @@
+import functools
+import hashlib
+import inspect
+import json
+import pathlib
+
+
+MANIFEST_NAME = ".build_manifest.json"
+
+
+def content_hash(*parts):
+    # Hash of a sequence of strings and bytes, the lengths are included so that the boundaries
+    # between the parts matter
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+@functools.cache
+def source_hash(obj):
+    # Hash of the source code of a function or module. For a functools.partial its arguments
+    # are part of the hash.
+    if isinstance(obj, functools.partial):
+        return content_hash(source_hash(obj.func), repr(obj.args), repr(sorted(obj.keywords.items())))
+    return content_hash(inspect.getsource(obj))
+
+
+def file_hash(path):
+    return content_hash(open(path, "rb").read())
+
+
+class BuildManifest:
+    # Input hashes of the files in one output directory, stored in the same directory. A file is
+    # up to date when it was last built from inputs with the same hash. Outputs that were skipped
+    # for these inputs are recorded as not written, so they aren't retried on every run.
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.manifest_file = self.path / MANIFEST_NAME
+        if self.manifest_file.exists():
+            self.entries = json.load(open(self.manifest_file))
+        else:
+            self.entries = {}
+        self.changed = False
+
+    def input_hash(self, file_name):
+        entry = self.entries.get(file_name)
+        return None if entry is None else entry["hash"]
+
+    def written(self, file_name):
+        entry = self.entries.get(file_name)
+        return entry is not None and entry["written"]
+
+    def up_to_date(self, file_name, input_hash):
+        entry = self.entries.get(file_name)
+        if entry is None or entry["hash"] != input_hash:
+            return False
+        return not entry["written"] or (self.path / file_name).exists()
+
+    def record(self, file_name, input_hash, written=True):
+        self.entries[file_name] = {"hash": input_hash, "written": written}
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        self.path.mkdir(parents=True, exist_ok=True)
+        json.dump(self.entries, open(self.manifest_file, "w"), indent=2)
@@ -0,0 +1,54 @@
+import concurrent.futures
+import multiprocessing
+import os
+import traceback
+
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+# Workers start while the fetch threads are running. Forking a multi-threaded process can
+# deadlock on locks that another thread held, a forkserver forks them from a clean process.
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+class StationPool:
+    # Runs per-station work in worker processes, or inline when num_workers is 1. Return values
+    # are collected in results, a failing station is recorded with its traceback instead of
+    # aborting the run.
+
+    def __init__(self, num_workers=DEFAULT_WORKERS):
+        if num_workers > 1:
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                num_workers, mp_context=multiprocessing.get_context(START_METHOD))
+        else:
+            self.executor = None
+        self.futures = {}
+        self.results = {}
+        self.failures = {}
+
+    def submit(self, station_id, func, *args):
+        if self.executor is None:
+            try:
+                self.results[station_id] = func(*args)
+            except Exception as e:
+                self.failures[station_id] = "".join(traceback.format_exception(e))
+        else:
+            self.futures[self.executor.submit(func, *args)] = station_id
+
+    def wait(self):
+        for future in concurrent.futures.as_completed(self.futures):
+            e = future.exception()
+            if e is not None:
+                self.failures[self.futures[future]] = "".join(traceback.format_exception(e))
+            else:
+                self.results[self.futures[future]] = future.result()
+        if self.executor is not None:
+            self.executor.shutdown()
+        return self.failures
+
+
+def report_failures(failures):
+    for station_id, error in failures.items():
+        print(f"Station {station_id} failed:")
+        print(error)
+    if failures:
+        print(f"{len(failures)} stations failed: {', '.join(failures.keys())}")
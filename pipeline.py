@@ -0,0 +1,60 @@
+import climate_pages
+import climate_tables
+import draw_charts
+import manifest
+import parallel
+from stations import stations_config, output_path
+
+
+# Set to False to skip writing the station data and tables as JSON. Charts and pages are built
+# from the tables in memory either way.
+write_tables = True
+# Set to 1 to process stations serially in this process
+process_workers = parallel.DEFAULT_WORKERS
+
+
+def build_station(station_id, station_datasets):
+    build_manifest = manifest.BuildManifest(output_path / stations_config[station_id]["slug"])
+    data_hashes = climate_tables.data_hashes(station_datasets)
+    table_hashes = climate_tables.table_hashes(station_id, data_hashes)
+    chart_hashes = draw_charts.chart_hashes(table_hashes)
+    chart_names = draw_charts.outdated_charts(build_manifest, chart_hashes)
+
+    # Only the tables of outdated outputs are built, the trend table is always needed for the
+    # combined trend table
+    table_names = draw_charts.chart_tables(chart_names) | {"trend"}
+    if write_tables:
+        table_names.update(climate_tables.outdated_tables(build_manifest, table_hashes))
+    tables, station_region_values = climate_tables.build_station_tables(
+        station_id, station_datasets, table_names)
+    if write_tables:
+        climate_tables.write_station_tables(station_datasets, tables, build_manifest, data_hashes, table_hashes)
+    station_charts = draw_charts.update_charts(build_manifest, chart_hashes, chart_names, tables)
+    build_manifest.save()
+    return {
+        "region": station_region_values,
+        "trend": tables.get("trend"),
+        "charts": station_charts
+    }
+
+
+def main():
+    # Same result as running climate_tables.py, draw_charts.py and climate_pages.py in order,
+    # but every station's tables are handed to the charts and pages in memory
+    pool = parallel.StationPool(process_workers)
+    fetch_failures = {}
+    for station_id, station_datasets in climate_tables.fetch_stations(fetch_failures):
+        pool.submit(station_id, build_station, station_id, station_datasets)
+    parallel.report_failures(fetch_failures | pool.wait())
+
+    region_tables, trend_table = climate_tables.make_region_tables(pool.results)
+    if write_tables:
+        climate_tables.write_region_tables(region_tables, trend_table)
+    climate_pages.write_pages(
+        {station_id: results["charts"] for station_id, results in pool.results.items()},
+        region_tables
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+import configparser
+import json
+import pathlib
+
+
+# Station list from stations_config.py, shared by all build steps
+stations_config = configparser.ConfigParser()
+stations_config.read_file(open("station_names.ini"))
+stations_meta = json.load(open("stations_meta.json"))
+output_path = pathlib.Path("out")